@@ -32,7 +32,11 @@ from packagekit.enums import *
 
 from packagekit.backend import PackageKitBaseBackend, get_package_id, \
     split_package_id
+from packagekit.filter import PackagekitFilter, PackagekitPredicateCache
+from packagekit.output import PackageKitBufferedOutput
 from packagekit.package import PackagekitPackage
+from packagekit.progress import PackagekitProgress
+from packagekit.watch import PackagekitWatch
 
 sys.path.insert(0, '/usr/lib/entropy/libraries')
 sys.path.insert(0, '/usr/lib/entropy/lib')
@@ -45,13 +49,11 @@ from entropy.client.interfaces import Client
 from entropy.client.interfaces.db import InstalledPackagesRepository
 from entropy.core.settings.base import SystemSettings
 from entropy.misc import LogFile
-from entropy.cache import EntropyCacher
 from entropy.exceptions import SystemDatabaseError, DependenciesNotFound, \
     DependenciesCollision, EntropyPackageException
 from entropy.db.exceptions import Error as EntropyRepositoryError
 from entropy.exceptions import DependenciesNotRemovable
 from entropy.fetchers import UrlFetcher
-from entropy.services.client import WebService
 from entropy.locks import EntropyResourcesLock
 
 import entropy.tools
@@ -114,6 +116,30 @@ def exclusiveinstlock(method):
     return wrapped
 
 
+class EntropyPackageFilter(PackagekitFilter):
+
+    """
+    PackagekitFilter on (repository id, package id, repository) tuples
+    """
+
+    def __init__(self, backend, fltlist, cache=None):
+        PackagekitFilter.__init__(self, fltlist, cache=cache)
+        self.backend = backend
+
+    def free(self, pkgs):
+        """
+        Return the set of the free packages of pkgs.
+        """
+        is_free = self._get_hook('_pkg_is_free')
+        return set([x for x in pkgs if is_free(x)])
+
+    def _pkg_get_key(self, pkg):
+        return (pkg[0], pkg[1])
+
+    def _pkg_is_free(self, pkg):
+        return self.backend._entropy.is_entropy_package_free(pkg[1], pkg[0])
+
+
 class PackageKitEntropyMixin(object):
 
     INST_PKGS_REPO_ID = "installed"
@@ -134,6 +160,16 @@ class PackageKitEntropyMixin(object):
             return 100
         return percent
 
+    @staticmethod
+    def get_progress(max_count):
+        """
+        Return a PackagekitProgress of max_count equal steps, to predict
+        the time left in long loops
+        """
+        return PackagekitProgress(
+            [float(count) / max_count * 100 for count in
+             range(1, max_count + 1)])
+
     def _log_message(self, source, *args):
         """
         Write log message to Entropy PackageKit log file.
@@ -320,13 +356,13 @@ class PackageKitEntropyMixin(object):
         """
         inst_pkgs_repo_id = PackageKitEntropyMixin.INST_PKGS_REPO_ID
 
-        if FILTER_INSTALLED in filters:
+        if filters.installed:
             pkgs = set([x for x in pkgs if x[0] == inst_pkgs_repo_id])
-        elif FILTER_NOT_INSTALLED in filters:
+        elif filters.not_installed:
             pkgs = set([x for x in pkgs if x[0] != inst_pkgs_repo_id])
-        if FILTER_FREE in filters:
-            pkgs = set([x for x in pkgs if
-                        self._entropy.is_entropy_package_free(x[1], x[0])])
+        if filters.free:
+            pkgs = EntropyPackageFilter(
+                self, filters, cache=self.filter_cache).free(pkgs)
 
         return pkgs
 
@@ -437,6 +473,9 @@ class PackageKitEntropyMixin(object):
         Inform repository maintainers that user fetched packages, if user
         enabled this feature.
         """
+        # only needed after downloads, keep it out of the startup path
+        from entropy.services.client import WebService
+
         if WebService is None:
             # old entropy library, ignore all
             return
@@ -550,18 +589,13 @@ class PackageKitEntropyMixin(object):
             return etp_pkg_id, inst_repo, self._etp_to_id(_etp_match)
 
         # remove
-        max_count = len(run_queue)
-        count = 0
-        for pkg_id in run_queue:
-            count += 1
-
-            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
+        progress = PackageKitEntropyMixin.get_progress(len(run_queue))
+        for pkg_id in self._pk_loop(progress, run_queue):
 
             self._log_message(__name__,
                               "_execute_etp_pkgs_remove: done %s/100" % (
-                                  percent,))
+                                  int(progress.percent),))
 
-            self.percentage(percent)
             map_item = match_map.get(pkg_id)
             if map_item is None:
                 map_item = _generate_map_item(pkg_id)
@@ -711,17 +745,12 @@ class PackageKitEntropyMixin(object):
         max_count = len(run_queue)
         if not only_fetch:
             max_count *= 2
-        count = 0
         down_data = {}
-        for match in run_queue:
-            count += 1
-
-            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
+        progress = PackageKitEntropyMixin.get_progress(max_count)
+        for match in self._pk_loop(progress, run_queue):
 
             self._log_message(__name__, "get_packages: done %s/100" % (
-                percent,))
-
-            self.percentage(percent)
+                int(progress.percent),))
 
             with inst_repo.shared():
                 pkg_id, pkg_c_repo, pk_pkg = match_map.get(match)
@@ -770,15 +799,10 @@ class PackageKitEntropyMixin(object):
         # install
         self.status(STATUS_INSTALL)
 
-        for match in run_queue:
-            count += 1
-
-            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
+        for match in self._pk_loop(progress, run_queue):
 
             self._log_message(__name__, "get_packages: done %s/100" % (
-                percent,))
-
-            self.percentage(percent)
+                int(progress.percent),))
 
             with inst_repo.shared():
                 pkg_id, pkg_c_repo, pk_pkg = match_map.get(match)
@@ -821,6 +845,9 @@ class PackageKitEntropyClient(Client):
 
     _pk_progress = None
     _pk_message = None
+    # PackagekitProgress of the running install loop, see _pk_loop()
+    _pk_loop = None
+    _pk_report = None
 
     def init_singleton(self):
         Client.init_singleton(self, url_fetcher=PkUrlFetcher)
@@ -842,7 +869,14 @@ class PackageKitEntropyClient(Client):
             return
 
         cur, tot = count[0], count[1]
-        progress(PackageKitEntropyMixin.get_percentage(cur, tot))
+        percent = PackageKitEntropyMixin.get_percentage(cur, tot)
+        loop = PackageKitEntropyClient._pk_loop
+        if loop is not None:
+            # count is the progress of the current package
+            loop.set_subpercent(percent)
+            PackageKitEntropyClient._pk_report(loop)
+            return
+        progress(percent)
 
 # in this way, any singleton class that tries to directly load Client
 # gets PackageKitEntropyClient in change
@@ -852,39 +886,70 @@ Client.__singleton_class__ = PackageKitEntropyClient
 class PkUrlFetcher(UrlFetcher):
 
     _pk_progress = None
-    _last_t = time.time()
+    _pk_speed = None
+    _pk_remaining = None
+    # PackagekitProgress of the running fetch loop, see _pk_loop()
+    _pk_loop = None
+    _pk_report = None
 
     def __init__(self, *args, **kwargs):
         self.__average = 0
         self.__downloadedsize = 0
         self.__remotesize = 0
         self.__datatransfer = 0
+        self.__time_remaining = None
         UrlFetcher.__init__(self, *args, **kwargs)
 
     def handle_statistics(self, th_id, downloaded_size, total_size,
                           average, old_average, update_step, show_speed, data_transfer,
                           time_remaining, time_remaining_secs):
+        loop = PkUrlFetcher._pk_loop
+        if loop is not None and downloaded_size > self.__downloadedsize:
+            loop.transferred(downloaded_size - self.__downloadedsize)
         self.__average = average
         self.__downloadedsize = downloaded_size
         self.__remotesize = total_size
         self.__datatransfer = data_transfer
+        self.__time_remaining = time_remaining_secs
 
     def update(self):
+        loop = PkUrlFetcher._pk_loop
+        if loop is not None:
+            # speed and time left of the whole loop, not of this file
+            loop.set_subpercent(self.__average)
+            PkUrlFetcher._pk_report(loop)
+            return
+
+        if PkUrlFetcher._pk_speed is not None:
+            PkUrlFetcher._pk_speed(int(self.__datatransfer))
+        if PkUrlFetcher._pk_remaining is not None:
+            PkUrlFetcher._pk_remaining(self.__time_remaining)
+
         if PkUrlFetcher._pk_progress is None:
             return
 
-        last_t = PkUrlFetcher._last_t
-        if (time.time() - last_t) > 1:
-            myavg = abs(int(round(float(self.__average), 1)))
-            cur_prog = int(float(self.__average) / 100)
-            PkUrlFetcher._pk_progress(cur_prog)
-            PkUrlFetcher._last_t = time.time()
+        # the backend drops repeated and too frequent updates
+        cur_prog = int(float(self.__average) / 100)
+        PkUrlFetcher._pk_progress(cur_prog)
 
 
 class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
 
     _log_fname = os.path.join(etpConst['syslogdir'], "packagekit.log")
 
+    # queries emit one line per package, send them in batches
+    output_class = PackageKitBufferedOutput
+
+    # queries only take the shared locks, run them side by side
+    # get-files is left out, file lists are streamed and would otherwise
+    # be held in memory until the whole command is done
+    read_only_commands = frozenset([
+        'depends-on', 'get-categories', 'get-details', 'get-packages',
+        'get-update-detail', 'get-updates', 'required-by', 'resolve',
+        'search-details', 'search-file', 'search-group', 'search-name',
+        'what-provides'])
+    concurrent_workers = 4
+
     # Entropy <-> PackageKit groups map
     GROUP_MAP = {
         'accessibility': GROUP_ACCESSIBILITY,
@@ -910,6 +975,7 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
 
         self._real_settings = None
         self._real_settings_lock = threading.Lock()
+        self._state_watches = {}
 
         self._real_action_factory = None
         self._real_action_factory_lock = threading.Lock()
@@ -920,9 +986,16 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
         self._real_entropy = None
         self._real_entropy_lock = threading.Lock()
 
+        # results of the EntropyPackageFilter hooks, cleared on reload
+        self.filter_cache = PackagekitPredicateCache()
+
         self.doLock()
         self._repo_name_cache = {}
         PackageKitEntropyClient._pk_progress = self.percentage
+        PkUrlFetcher._pk_speed = self.speed
+        PkUrlFetcher._pk_remaining = self.remaining
+        PkUrlFetcher._pk_report = self.progress
+        PackageKitEntropyClient._pk_report = self.progress
         PackageKitEntropyClient._pk_message = self._generic_message
 
     @property
@@ -934,7 +1007,13 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
             with self._real_entropy_lock:
 
                 if self._real_entropy is None:
-                    self._real_entropy = PackageKitEntropyClient()
+                    if 'PK_BACKEND_SYNTHETIC' in os.environ:
+                        # benchmarks only, see entropySynthetic
+                        import entropySynthetic
+                        self._real_entropy = \
+                            entropySynthetic.SyntheticEntropyClient.from_environment()
+                    else:
+                        self._real_entropy = PackageKitEntropyClient()
 
         return self._real_entropy
 
@@ -975,13 +1054,67 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
         if self._real_settings is None:
             with self._real_settings_lock:
                 if self._real_settings is None:
-                    self._real_settings = SystemSettings()
+                    settings = SystemSettings()
+                    self._state_watches = self._watch_state(settings)
+                    self._real_settings = settings
 
         return self._real_settings
 
+    def _watch_state(self, settings):
+        """
+        Return the watches telling when the loaded configuration and
+        repositories went stale.
+        """
+        repo_dbs = [os.path.join(repo_data['dbpath'],
+                                 etpConst['etpdatabasefile'])
+                    for repo_data in
+                    settings['repositories']['available'].values()]
+        repo_dbs.append(etpConst['etpdatabaseclientfilepath'])
+
+        watches = {
+            'config': PackagekitWatch(trees=[etpConst['confdir']]),
+            'repositories': PackagekitWatch(repo_dbs),
+        }
+        for watch in watches.values():
+            watch.changed()
+        return watches
+
+    def stale_state(self):
+        return sorted(name for name, watch in self._state_watches.items()
+                      if watch.changed())
+
+    def reload_state(self, stale):
+        if "config" in stale:
+            self._settings.clear()
+            self._repo_name_cache = {}
+            self._state_watches = self._watch_state(self._settings)
+        # repositories are opened again on first use
+        if self._real_entropy is not None:
+            self._entropy.close_repositories()
+        self.filter_cache.clear()
+
     def unLock(self):
         PackageKitBaseBackend.unLock(self)
 
+    def _pk_loop(self, progress, items):
+        """
+        Yield items, sending the progress before each one and stepping it
+        after. Meanwhile the client and the URL fetcher report the bytes
+        and the progress of the current item in progress.
+        """
+        PackageKitEntropyClient._pk_loop = progress
+        PkUrlFetcher._pk_loop = progress
+        try:
+            for item in items:
+                self.progress(progress)
+                yield item
+                progress.step()
+            self.progress(progress)
+        finally:
+            # also run when the caller returns from the loop early
+            PackageKitEntropyClient._pk_loop = None
+            PkUrlFetcher._pk_loop = None
+
     def _convert_date_to_iso8601(self, unix_time_str):
         unix_time = float(unix_time_str)
         ux_t = time.localtime(unix_time)
@@ -1227,9 +1360,8 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
                 percent,))
 
             self.percentage(percent)
-            files = repo_db.retrieveContent(pkg_id, order_by='file')
-            files = ";".join(files)
-            self.files(pk_pkg, files)
+            files = repo_db.retrieveContentIter(pkg_id, order_by='file')
+            self.files(pk_pkg, (path for path, ftype in files))
 
         self.percentage(100)
 
@@ -1598,6 +1730,9 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
         """
         Update repository download statistics.
         """
+        # only needed after downloads, keep it out of the startup path
+        from entropy.services.client import WebService
+
         if WebService is None:
             # old entropy library, ignore all
             return
@@ -1912,6 +2047,7 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
         self.percentage(100)
 
     @sharedreslock
+    @sharedinstlock
     def search_name(self, filters, values):
 
         values = self._encode_string_list(values)
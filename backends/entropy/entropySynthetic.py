@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# This file contains the stand-ins for the Entropy client and repositories
+# used by entropyBackend.py when PK_BACKEND_SYNTHETIC is set, it is only
+# imported then.
+#
+
+import contextlib
+
+from packagekit import synthetic
+
+from entropy.const import etpConst
+from entropy.client.interfaces.db import InstalledPackagesRepository
+
+
+class SyntheticEntropyRepository(object):
+
+    """
+    The part of the EntropyRepository API used by the backend, serving
+    packages of a synthetic universe (see packagekit.synthetic).
+    """
+
+    def __init__(self, name, packages, universe):
+        self.name = name
+        self._universe = universe
+        self._packages = dict((pkg.index + 1, pkg) for pkg in packages)
+        self._atoms = {}
+        for pkg_id, pkg in self._packages.items():
+            slot = etpConst['entropyslotprefix'] + pkg.slot
+            for key in (pkg.cp, pkg.name, pkg.cpv, pkg.cp + slot,
+                        pkg.cpv + slot):
+                self._atoms.setdefault(key, set()).add(pkg_id)
+
+    @contextlib.contextmanager
+    def shared(self):
+        yield self
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        yield self
+
+    def _search(self, keyword, attribute):
+        keyword = keyword.lower()
+        return set(pkg_id for pkg_id, pkg in self._packages.items()
+                   if keyword in getattr(pkg, attribute).lower())
+
+    def listAllPackageIds(self, order_by=None):
+        return sorted(self._packages)
+
+    def listAllCategories(self):
+        return sorted(set(pkg.category for pkg in self._packages.values()))
+
+    def listPackageIdsInCategory(self, category, order_by=None):
+        return set(pkg_id for pkg_id, pkg in self._packages.items()
+                   if pkg.category == category)
+
+    def getStrictData(self, pkg_id):
+        pkg = self._packages[pkg_id]
+        version = pkg.version
+        if pkg.revision:
+            version += "-r%d" % (pkg.revision,)
+        return pkg.cp, pkg.slot, version, "", 0, pkg.cpv
+
+    def retrieveAtom(self, pkg_id):
+        return self._packages[pkg_id].cpv
+
+    def retrieveCategory(self, pkg_id):
+        return self._packages[pkg_id].category
+
+    def retrieveDescription(self, pkg_id):
+        return self._packages[pkg_id].description
+
+    def retrieveHomepage(self, pkg_id):
+        return self._packages[pkg_id].homepage
+
+    def retrieveLicense(self, pkg_id):
+        return self._packages[pkg_id].license
+
+    def retrieveSize(self, pkg_id):
+        return self._packages[pkg_id].size
+
+    def retrieveOnDiskSize(self, pkg_id):
+        return self._packages[pkg_id].size * 3
+
+    def retrieveKeySlotAggregated(self, pkg_id):
+        pkg = self._packages[pkg_id]
+        return pkg.cp + etpConst['entropyslotprefix'] + pkg.slot
+
+    def retrieveCreationDate(self, pkg_id):
+        return str(1300000000 + pkg_id * 3600)
+
+    def retrieveChangelog(self, pkg_id):
+        return None
+
+    def retrieveCategoryDescription(self, category):
+        return {}
+
+    def retrieveContent(self, pkg_id, extended=False, formatted=False,
+                        insert_formatted=False, order_by=None):
+        files = self._universe.contents(self._packages[pkg_id])
+        return sorted(files) if order_by else files
+
+    def retrieveContentIter(self, pkg_id, order_by=None, reverse=False):
+        files = self.retrieveContent(pkg_id, order_by=order_by)
+        if reverse:
+            files = reversed(files)
+        return ((path, "obj") for path in files)
+
+    def searchPackages(self, keyword, just_id=False, **kwargs):
+        return self._search(keyword, "cpv")
+
+    def searchDescription(self, keyword, just_id=False):
+        return self._search(keyword, "description")
+
+    def searchHomepage(self, keyword, just_id=False):
+        return self._search(keyword, "homepage")
+
+    def searchLicense(self, keyword, just_id=False):
+        return self._search(keyword, "license")
+
+    def searchProvidedMime(self, mimetype):
+        return set()
+
+    def searchBelongs(self, bfile, like=False):
+        return set(pkg_id for pkg_id, pkg in self._packages.items()
+                   if bfile in self._universe.contents(pkg))
+
+    def atomMatch(self, atom, multiMatch=False, **kwargs):
+        pkg_ids = self._atoms.get(atom, set())
+        if multiMatch:
+            return set(pkg_ids), 0 if pkg_ids else 1
+        if not pkg_ids:
+            return -1, 1
+        return max(pkg_ids), 0
+
+
+class SyntheticEntropyClient(object):
+
+    """
+    The part of the Entropy Client API used by the backend, serving a
+    synthetic universe instead of the system repositories.
+    """
+
+    REPOSITORY_ID = "synthetic"
+
+    # Entropy groups, matched by category prefix
+    GROUPS = {
+        'accessibility': ['app-accessibility'],
+        'development': ['dev-'],
+        'games': ['games-'],
+        'gnome': ['gnome-'],
+        'kde': ['kde-'],
+        'lxde': ['lxde-'],
+        'multimedia': ['media-'],
+        'networking': ['net-'],
+        'office': ['app-office'],
+        'science': ['sci-'],
+        'security': ['sec-'],
+        'system': ['sys-'],
+        'x11': ['x11-'],
+        'xfce': ['xfce-'],
+    }
+
+    def __init__(self, universe):
+        self._universe = universe
+        installed_id = etpConst.get(
+            'clientdbid', getattr(InstalledPackagesRepository, "NAME", None))
+        self._installed = SyntheticEntropyRepository(
+            installed_id, [pkg for pkg in universe.packages if pkg.installed],
+            universe)
+        self._repositories = {
+            self.REPOSITORY_ID: SyntheticEntropyRepository(
+                self.REPOSITORY_ID, universe.packages, universe),
+        }
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Return a client serving the universe asked for with
+        PK_BACKEND_SYNTHETIC.
+        """
+        return cls(synthetic.PackagekitSyntheticUniverse.from_environment())
+
+    def installed_repository(self):
+        return self._installed
+
+    def open_repository(self, repository_id):
+        if repository_id == self._installed.name:
+            return self._installed
+        return self._repositories[repository_id]
+
+    def repositories(self):
+        return sorted(self._repositories)
+
+    def close_repositories(self, mask_clear=True):
+        pass
+
+    def get_package_groups(self):
+        groups = {}
+        for name, prefixes in self.GROUPS.items():
+            groups[name] = {
+                'name': name,
+                'description': name,
+                'categories': [x for x in self._universe.categories
+                               if any(x.startswith(p) for p in prefixes)],
+            }
+        return groups
+
+    def is_entropy_package_free(self, pkg_id, repository_id):
+        if repository_id in self._repositories:
+            repo = self._repositories[repository_id]
+        else:
+            repo = self._installed
+        licenses = set(repo.retrieveLicense(pkg_id).split()) - \
+            set(["||", "(", ")", "ssl?"])
+        return licenses <= synthetic.FREE_LICENSES
+
+    def calculate_updates(self, **kwargs):
+        repo = self._repositories[self.REPOSITORY_ID]
+        update = []
+        for pkg_id, pkg in sorted(self._installed._packages.items()):
+            keyslot = pkg.cp + etpConst['entropyslotprefix'] + pkg.slot
+            # ids grow with versions within a package
+            newest = max(repo._atoms[keyslot])
+            if newest > pkg_id:
+                update.append((newest, self.REPOSITORY_ID))
+        return {'update': update, 'remove': [], 'fine': [], 'spm_fine': []}
+
+    def get_install_queue(self, matches, empty, deep, recursive=True,
+                          **kwargs):
+        repo = self._repositories[self.REPOSITORY_ID]
+        wanted = {}
+        stack = [self.open_repository(repository_id)._packages[pkg_id]
+                 for pkg_id, repository_id in matches]
+        while stack:
+            for cp in stack.pop().depends:
+                if cp in wanted or (not empty and cp in self._installed._atoms):
+                    continue
+                wanted[cp] = max(repo._atoms[cp])
+                if recursive:
+                    stack.append(repo._packages[wanted[cp]])
+        # packages only depend on the ones generated before them
+        install = [(pkg_id, self.REPOSITORY_ID)
+                   for pkg_id in sorted(wanted.values())]
+        install.extend(match for match in matches if match not in install)
+        return install, []
+
+    def get_reverse_queue(self, matches, deep=False, recursive=True,
+                          **kwargs):
+        cps = set(self.open_repository(repository_id)._packages[pkg_id].cp
+                  for pkg_id, repository_id in matches)
+        found = set()
+        while cps:
+            new = [pkg_id for pkg_id, pkg in self._installed._packages.items()
+                   if pkg_id not in found and cps.intersection(pkg.depends)]
+            found.update(new)
+            cps = set(self._installed._packages[x].cp for x in new) \
+                if recursive else None
+        return [(pkg_id, self._installed.name) for pkg_id in sorted(found)]
+
+    def atom_match(self, atom, multi_match=False, **kwargs):
+        for repository_id in self.repositories():
+            pkg_id, pkg_rc = self._repositories[repository_id].atomMatch(
+                atom, multiMatch=multi_match)
+            if pkg_rc == 0:
+                if multi_match:
+                    return set((x, repository_id) for x in pkg_id), 0
+                return pkg_id, repository_id
+        if multi_match:
+            return set(), 1
+        return -1, 1
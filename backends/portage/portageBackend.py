@@ -21,10 +21,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import glob
 import os
 import re
 import signal
 import sys
+import threading
 import traceback
 from collections import defaultdict
 try:
@@ -32,10 +34,6 @@ try:
 except ImportError:
     izip = zip
 
-# layman imports (>=2)
-import layman.config
-import layman.db
-import layman.remotedb
 # packagekit imports
 from packagekit.backend import (
     PackageKitBaseBackend,
@@ -43,16 +41,23 @@ from packagekit.backend import (
     split_package_id,
 )
 from packagekit.enums import *
+from packagekit.filter import PackagekitFilter, PackagekitFilterFlags, \
+    PackagekitPredicateCache
+from packagekit.output import PackageKitBufferedOutput
 from packagekit.progress import PackagekitProgress
+from packagekit.watch import PackagekitWatch
+try:
+    import sqlite3
+    from packagekit.index import INSTALLED, PackagekitIndex
+except ImportError:
+    # python built without sqlite, queries walk the package databases
+    PackagekitIndex = None
 # portage imports
-import _emerge.AtomArg
-import _emerge.actions
-import _emerge.create_depgraph_params
-import _emerge.stdout_spinner
+# _emerge and layman are imported by the methods using them, the
+# dispatcher should not pay for them on every command
 import portage
 import portage.dep
 import portage.versions
-from portage._sets.base import InternalPackageSet
 from portage.exception import InvalidAtom
 
 # NOTES:
@@ -164,6 +169,36 @@ class PortagePackageGroups(dict):
         self.update(data)
 
 
+class PortagePackageFilter(PackagekitFilter):
+
+    '''
+    PackagekitFilter on cpvs, the versions of a package are grouped by
+    slot
+    '''
+
+    def __init__(self, backend, fltlist, cache=None):
+        PackagekitFilter.__init__(self, fltlist, cache=cache)
+        self.backend = backend
+
+    def newest(self, cpv_list):
+        """Return the newest installed and available cpv of every slot."""
+        is_installed = self._get_hook('_pkg_is_installed')
+        package_list = [
+            (cpv, INFO_INSTALLED if is_installed(cpv)
+             else INFO_AVAILABLE) for cpv in cpv_list]
+        return [cpv for cpv, state in self._filter_newest(package_list)]
+
+    def _pkg_compare(self, pkg1, pkg2):
+        return self.backend._cmp_cpv(pkg1, pkg2)
+
+    def _pkg_get_name(self, pkg):
+        return (portage.versions.cpv_getkey(pkg),
+                self.backend._get_metadata(pkg, ["SLOT"])[0])
+
+    def _pkg_is_installed(self, pkg):
+        return self.backend._is_installed(pkg)
+
+
 class PortageBridge():
 
     '''
@@ -171,6 +206,9 @@ class PortageBridge():
     and be sure they are always up-to-date.
     '''
 
+    # commands the loaded package databases can't answer
+    unsupported_commands = frozenset()
+
     def __init__(self):
         self.settings = None
         self.trees = None
@@ -178,10 +216,22 @@ class PortageBridge():
         self.vardb = None
         self.portdb = None
         self.root_config = None
+        # bumped every time the loaded state changes, for caches
+        self.generation = 0
+        self._watches = {}
+        # persistent index of the packages, None if it can't be used
+        self.index = None
 
         self.update()
 
-    def update(self):
+    def update(self, force=False):
+        """
+        Load the portage settings and databases again.
+        @param force: check every package of the index again, not only the
+        ones of the sources whose stamp changed
+        """
+        import _emerge.actions
+
         self.settings, self.trees, self.mtimedb = \
             _emerge.actions.load_emerge_config()
         self.vardb = self.trees[self.settings['ROOT']]['vartree'].dbapi
@@ -198,6 +248,124 @@ class PortageBridge():
             ]),
         })
 
+        self._watch_state()
+        self._sync_index(force)
+        self.generation += 1
+
+    def _watch_state(self):
+        root = self.settings['ROOT']
+        config_root = self.settings['PORTAGE_CONFIGROOT']
+        portdirs = [self.settings['PORTDIR']] + \
+            self.settings.get('PORTDIR_OVERLAY', '').split()
+
+        self._watches = {
+            'config': PackagekitWatch(
+                [os.path.join(config_root, 'etc', 'make.conf')],
+                [os.path.join(config_root, portage.const.USER_CONFIG_PATH)]),
+            # a sync updates the timestamps of the repository, adding or
+            # removing a package touches its category directory; editing
+            # an ebuild in place changes neither, see refresh_cache
+            'trees': PackagekitWatch(portdirs + [
+                path for portdir in portdirs for path in sorted(glob.glob(
+                    os.path.join(portdir, 'metadata', 'timestamp*')))] + [
+                os.path.join(portdir, category) for portdir in portdirs
+                for category in sorted(self.settings.categories)]),
+            # the counter is bumped by every merge and unmerge
+            'vdb': PackagekitWatch([
+                os.path.join(root, portage.const.VDB_PATH),
+                os.path.join(root, portage.const.CACHE_PATH, 'counter')]),
+        }
+        for watch in self._watches.values():
+            watch.changed()
+
+    def stale(self):
+        """Return the parts of the loaded state that changed on disk."""
+        return sorted(name for name, watch in self._watches.items()
+                      if watch.changed())
+
+    def refresh(self, stale):
+        """Reload the parts returned by stale()."""
+        if 'config' in stale or 'trees' in stale:
+            self.update()
+        elif 'vdb' in stale:
+            # installed packages changed, settings and ebuilds are still
+            # valid, only the installed packages database is read again
+            root = self.settings['ROOT']
+            self.trees[root]['vartree'] = portage.vartree(
+                settings=self.settings)
+            self.vardb = self.trees[root]['vartree'].dbapi
+            self._sync_index()
+            self.generation += 1
+
+    # metadata stored in the package index, the keys queries ask for,
+    # search_details looks into all of them
+    index_keys = ['DESCRIPTION', 'EAPI', 'HOMEPAGE', 'IUSE', 'KEYWORDS',
+                  'LICENSE', 'SLOT', 'repository']
+
+    def _index_path(self):
+        try:
+            return os.environ['PK_PORTAGE_INDEX']
+        except KeyError:
+            return os.path.join(self.settings['ROOT'],
+                                portage.const.CACHE_PATH,
+                                'packagekit-index.sqlite')
+
+    def _sync_index(self, force=False):
+        """Bring the package index up to date with the databases."""
+        if PackagekitIndex is None:
+            return
+        try:
+            if self.index is None:
+                self.index = PackagekitIndex(self._index_path(),
+                                             self.index_keys, self.index_keys)
+            self.index.sync(self, force)
+        except (sqlite3.Error, IOError, OSError) as e:
+            # e.g. a read-only cache directory, answer from portage
+            sys.stderr.write("package index disabled: %s\n" % e)
+            self.index = None
+
+    def index_sources(self):
+        """Return the stamps of the installed packages and of the trees."""
+        return {
+            INSTALLED: repr(self._watches['vdb'].snapshot()),
+            # visibility depends on the configuration
+            'tree': repr((self._watches['trees'].snapshot(),
+                          self._watches['config'].snapshot())),
+        }
+
+    def index_scan(self, source):
+        """Return the visible cpvs of a source with their stamps."""
+        if source == INSTALLED:
+            # the counter changes when a cpv is merged again
+            return dict((cpv, self.vardb.aux_get(cpv, ['COUNTER'])[0])
+                        for cpv in self.vardb.cpv_all())
+
+        cpvs = {}
+        for cp in self.portdb.cp_all():
+            for cpv in self.portdb.match(cp):
+                cpvs[cpv] = self._ebuild_stamp(cpv)
+        return cpvs
+
+    def _ebuild_stamp(self, cpv):
+        ebuild, tree = self.portdb.findname2(cpv)
+        if ebuild is None:
+            return ''
+        # the metadata cache entry also changes with the eclasses
+        for path in (os.path.join(tree, 'metadata', 'md5-cache', cpv),
+                     ebuild):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            return '%s %d %d' % (path, st.st_mtime, st.st_size)
+        return ''
+
+    def index_fetch(self, source, cpv):
+        """Return the cp and the indexed metadata of a cpv."""
+        db = self.vardb if source == INSTALLED else self.portdb
+        return (portage.versions.cpv_getkey(cpv),
+                db.aux_get(cpv, self.index_keys))
+
     def apply_settings(self, mapping):
         """Set portage settings."""
         self.settings.unlock()
@@ -209,13 +377,46 @@ class PortageBridge():
         self.settings.regenerate()
         self.settings.lock()
 
+    def ebuild_settings(self, cpv, metadata):
+        """Return the settings used to build given cpv."""
+        settings = portage.config(clone=self.settings)
+        settings.setcpv(cpv, mydb=metadata)
+        return settings
+
+    def fetch_size(self, cpv, metadata):
+        """Return the size of the files to download to build given cpv."""
+        import _emerge.Package
+
+        package = _emerge.Package.Package(
+            type_name="ebuild",
+            built=False,
+            installed=False,
+            root_config=self.root_config,
+            cpv=cpv,
+            metadata=metadata
+        )
+        fetch_file = self.portdb.getfetchsizes(package[2],
+                                               package.use.enabled)
+        return sum(fetch_file.values())
+
+    def contents(self, cpv):
+        """Return the files installed by given cpv."""
+        cat, pv = portage.versions.catsplit(cpv)
+        db = portage.dblink(cat, pv, self.settings['ROOT'],
+                            self.settings, treetype="vartree",
+                            vartree=self.vardb)
+
+        contents = db.getcontents()
+        return contents.keys() if contents else []
+
 
 class PackageKitPortageMixin(object):
 
     def __init__(self):
         object.__init__(self)
 
-        self.pvar = PortageBridge()
+        self._real_pvar = None
+        self._real_pvar_lock = threading.Lock()
         # TODO: should be removed when using non-verbose function API
         # FIXME: avoid using /dev/null, dangerous (ro fs)
         self._dev_null = open('/dev/null', 'w')
@@ -223,9 +424,33 @@ class PackageKitPortageMixin(object):
         self._elog_messages = []
         self._error_message = ""
         self._error_phase = ""
+        # lookup tables built for the current PortageBridge generation
+        self._caches = defaultdict(dict)
+        self._cache_generation = None
+        # results of the PortagePackageFilter hooks, cleared on reload
+        self.filter_cache = PackagekitPredicateCache()
+
+    @property
+    def pvar(self):
+        """
+        Return the PortageBridge, the emerge config is loaded on first use.
+        """
+        if self._real_pvar is None:
+            with self._real_pvar_lock:
+                if self._real_pvar is None:
+                    if 'PK_BACKEND_SYNTHETIC' in os.environ:
+                        # benchmarks only, see portageSynthetic
+                        import portageSynthetic
+                        self._real_pvar = portageSynthetic.bridge(PortageBridge)
+                    else:
+                        self._real_pvar = PortageBridge()
+
+        return self._real_pvar
 
     # TODO: should be removed when using non-verbose function API
     def _block_output(self):
+        # pending signals must not end up in /dev/null
+        self.flush_output()
         sys.stdout = self._dev_null
         sys.stderr = self._dev_null
 
@@ -301,19 +526,53 @@ class PackageKitPortageMixin(object):
 
         return groups
 
+    def _get_category_groups(self):
+        """
+        Return a dict mapping Portage categories to PackageKit groups
+        """
+        cache = self._get_cache('groups')
+        try:
+            return cache['categories']
+        except KeyError:
+            pass
+
+        category_groups = {}
+        for name, data in self._get_portage_groups().items():
+            # first group listing a category wins, e.g. sys-devel is
+            # development and not system
+            for category in data['categories']:
+                category_groups.setdefault(
+                    category, PackageKitPortageBackend.GROUP_MAP[name])
+
+        cache['categories'] = category_groups
+        return category_groups
+
     def _get_pk_group(self, cp):
         """
         Return PackageKit group belonging to given Portage package.
         """
         category = portage.versions.catsplit(cp)[0]
-        group_data = [key for key, data in self._get_portage_groups().items()
-                      if category in data['categories']]
+        return self._get_category_groups().get(category, GROUP_UNKNOWN)
+
+    def _get_group_cps(self, filters):
+        """
+        Return a dict mapping PackageKit groups to the cps of _get_all_cp
+        belonging to them
+        """
+        cp_list = self._get_all_cp(filters)
+        cache = self._get_cache('group_cps')
+        installed = self._index_installed(filters)
         try:
-            generic_group_name = group_data.pop(0)
-        except IndexError:
-            return GROUP_UNKNOWN
+            return cache[installed]
+        except KeyError:
+            pass
+
+        group_cps = defaultdict(list)
+        for cp in cp_list:
+            group_cps[self._get_pk_group(cp)].append(cp)
 
-        return PackageKitPortageBackend.GROUP_MAP[generic_group_name]
+        cache[installed] = dict(group_cps)
+        return cache[installed]
 
     def _get_portage_group(self, pk_group):
         """
@@ -328,9 +587,7 @@ class PackageKitPortageMixin(object):
         """
         Return values of given metadata keys for given Portage CPV.
         """
-        settings = portage.config(clone=self.pvar.settings)
-        settings.setcpv(cpv, mydb=metadata)
-        return settings
+        return self.pvar.ebuild_settings(cpv, metadata)
 
     def _is_installed(self, cpv):
         return self.pvar.vardb.cpv_exists(cpv)
@@ -464,13 +721,7 @@ class PackageKitPortageMixin(object):
         self.error(error_type, self._error_message)
 
     def _get_file_list(self, cpv):
-        cat, pv = portage.versions.catsplit(cpv)
-        db = portage.dblink(cat, pv, self.pvar.settings['ROOT'],
-                            self.pvar.settings, treetype="vartree",
-                            vartree=self.pvar.vardb)
-
-        contents = db.getcontents()
-        return contents.keys() if contents else []
+        return self.pvar.contents(cpv)
 
     def _cmp_cpv(self, cpv1, cpv2):
         '''
@@ -481,31 +732,18 @@ class PackageKitPortageMixin(object):
         return portage.versions.pkgcmp(portage.versions.pkgsplit(cpv1),
                                        portage.versions.pkgsplit(cpv2))
 
-    def _get_newest_cpv(self, cpv_list, installed):
-        newer = ""
-
-        # get the first cpv following the installed rule
-        for cpv in cpv_list:
-            if self._is_installed(cpv) == installed:
-                newer = cpv
-                break
-
-        if newer == "":
-            return ""
-
-        for cpv in cpv_list:
-            if self._is_installed(cpv) == installed:
-                if self._cmp_cpv(cpv, newer) == 1:
-                    newer = cpv
-
-        return newer
-
     def _get_metadata(self, cpv, keys, in_dict=False, add_cache_keys=False):
         '''
         This function returns required metadata.
         If in_dict is True, metadata is returned in a dict object.
         If add_cache_keys is True, cached keys are added to keys in parameter.
         '''
+        index = self.pvar.index
+        if index is not None and not add_cache_keys and index.has_keys(keys):
+            values = index.metadata(cpv, keys)
+            if values is not None:
+                return dict(izip(keys, values)) if in_dict else values
+
         db = self.pvar.vardb if self._is_installed(cpv) else self.pvar.portdb
 
         if add_cache_keys:
@@ -529,18 +767,7 @@ class PackageKitPortageMixin(object):
             size = int(size) if size else 0
         else:
             metadata = self._get_metadata(cpv, ["IUSE", "SLOT"], in_dict=True)
-
-            package = _emerge.Package.Package(
-                type_name="ebuild",
-                built=False,
-                installed=False,
-                root_config=self.pvar.root_config,
-                cpv=cpv,
-                metadata=metadata
-            )
-            fetch_file = self.pvar.portdb.getfetchsizes(package[2],
-                                                        package.use.enabled)
-            size = sum(fetch_file)
+            size = self.pvar.fetch_size(cpv, metadata)
 
         return size
 
@@ -562,12 +789,12 @@ class PackageKitPortageMixin(object):
                 cpv, ["LICENSE", "USE", "SLOT"], True)
             return not self.pvar.settings._getMissingLicenses(cpv, metadata)
 
-        if FILTER_FREE in filters or FILTER_NOT_FREE in filters:
+        if filters.mask & PackagekitFilterFlags.FREE:
             licenses = ""
             free_licenses = "@FSF-APPROVED"
-            if FILTER_FREE in filters:
+            if filters.free:
                 licenses = "-* " + free_licenses
-            elif FILTER_NOT_FREE in filters:
+            elif filters.not_free:
                 licenses = "* -" + free_licenses
             backup_licenses = self.pvar.settings["ACCEPT_LICENSE"]
 
@@ -581,56 +808,88 @@ class PackageKitPortageMixin(object):
         if len(cpv_list) == 0:
             return cpv_list
 
-        if FILTER_NEWEST not in filters:
+        if not filters.newest:
             return cpv_list
 
-        if FILTER_INSTALLED in filters:
+        if filters.installed:
             # we have one package per slot, so it's the newest
             return cpv_list
 
-        cpv_dict = self._get_cpv_slotted(cpv_list)
+        return PortagePackageFilter(
+            self, filters, cache=self.filter_cache).newest(cpv_list)
 
-        # slots are sorted (dict), revert them to have newest slots first
-        slots = cpv_dict.keys()
-        slots.reverse()
-
-        # empty cpv_list, cpv are now in cpv_dict and cpv_list gonna be repop
-        cpv_list = []
-
-        for k in slots:
-            # if not_intalled on, no need to check for newest installed
-            if FILTER_NOT_INSTALLED not in filters:
-                newest_installed = self._get_newest_cpv(cpv_dict[k], True)
-                if newest_installed != "":
-                    cpv_list.append(newest_installed)
-            newest_available = self._get_newest_cpv(cpv_dict[k], False)
-            if newest_available != "":
-                cpv_list.append(newest_available)
+    def _index_installed(self, filters):
+        '''
+        Return the installed argument of the package index for filters
+        '''
+        if filters.installed:
+            return True
+        if filters.not_installed:
+            return False
+        return None
 
-        return cpv_list
+    def _get_cache(self, name):
+        '''
+        Return a dict emptied every time the PortageBridge generation
+        changes
+        '''
+        if self._cache_generation != self.pvar.generation:
+            self._caches = defaultdict(dict)
+            self._cache_generation = self.pvar.generation
+        return self._caches[name]
 
     def _get_all_cp(self, filters):
         # NOTES:
-        # returns a list of cp
+        # returns a tuple of cp, shared by the commands until the
+        # PortageBridge generation changes
         #
         # FILTERS:
         # - installed: ok
         # - free: ok (should be done with cpv)
         # - newest: ok (should be finished with cpv)
-        cp_list = []
+        cache = self._get_cache('all_cp')
+        installed = self._index_installed(filters)
+        try:
+            return cache[installed]
+        except KeyError:
+            pass
 
-        if FILTER_INSTALLED in filters:
+        if self.pvar.index is not None:
+            cp_list = self.pvar.index.names(installed)
+        elif filters.installed:
             cp_list = self.pvar.vardb.cp_all()
-        elif FILTER_NOT_INSTALLED in filters:
+        elif filters.not_installed:
             cp_list = self.pvar.portdb.cp_all()
         else:
             # need installed packages first
             cp_list = self.pvar.vardb.cp_all()
-            for cp in self.pvar.portdb.cp_all():
-                if cp not in cp_list:
-                    cp_list.append(cp)
+            seen = set(cp_list)
+            cp_list.extend(cp for cp in self.pvar.portdb.cp_all()
+                           if cp not in seen)
 
-        return cp_list
+        cache[installed] = tuple(cp_list)
+        return cache[installed]
+
+    def _get_cp_names(self, filters):
+        '''
+        Return a dict mapping every cp and every package name to the
+        cps of _get_all_cp having it
+        '''
+        cp_list = self._get_all_cp(filters)
+        cache = self._get_cache('cp_names')
+        installed = self._index_installed(filters)
+        try:
+            return cache[installed]
+        except KeyError:
+            pass
+
+        names = {}
+        for cp in cp_list:
+            names[cp] = [cp]
+            names.setdefault(portage.versions.catsplit(cp)[1], []).append(cp)
+
+        cache[installed] = names
+        return names
 
     def _get_all_cpv(self, cp, filters, filter_newest=True):
         # NOTES:
@@ -644,9 +903,12 @@ class PackageKitPortageMixin(object):
         cpv_list = []
 
         # populate cpv_list taking care of installed filter
-        if FILTER_INSTALLED in filters:
+        if self.pvar.index is not None:
+            cpv_list = self.pvar.index.packages(
+                cp, self._index_installed(filters))
+        elif filters.installed:
             cpv_list = self.pvar.vardb.match(cp)
-        elif FILTER_NOT_INSTALLED in filters:
+        elif filters.not_installed:
             cpv_list = [cpv for cpv in self.pvar.portdb.match(cp)
                         if not self._is_installed(cpv)]
         else:
@@ -728,6 +990,11 @@ class PackageKitPortageMixin(object):
         Get a list of cpv and recursive parameter.
         Returns the list of packages required for cpv list.
         '''
+        import _emerge.Dependency
+        import _emerge.SetArg
+        import _emerge.create_depgraph_params
+        import _emerge.depgraph
+
         packages_list = []
 
         myopts = {}
@@ -742,8 +1009,9 @@ class PackageKitPortageMixin(object):
 
         # TODO: atm, using FILTER_INSTALLED because it's quicker
         # and we don't want to manage non-installed packages
-        for cp in self._get_all_cp([FILTER_INSTALLED]):
-            for cpv in self._get_all_cpv(cp, [FILTER_INSTALLED]):
+        installed = PackagekitFilterFlags.parse(FILTER_INSTALLED)
+        for cp in self._get_all_cp(installed):
+            for cpv in self._get_all_cpv(cp, installed):
                 depgraph._dynamic_config._dep_stack.append(
                     _emerge.Dependency.Dependency(
                         atom=portage.dep.Atom('=' + cpv),
@@ -783,6 +1051,9 @@ class PackageKitPortageMixin(object):
 
 class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
 
+    # queries emit one line per ebuild, send them in batches
+    output_class = PackageKitBufferedOutput
+
     # Portage <-> PackageKit groups map
     GROUP_MAP = {
         'accessibility': GROUP_ACCESSIBILITY,
@@ -810,6 +1081,28 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         PackageKitPortageMixin.__init__(self)
         PackageKitBaseBackend.__init__(self, args)
 
+    def stale_state(self):
+        # nothing to reload before the first command needing portage
+        if self._real_pvar is None:
+            return []
+        return self.pvar.stale()
+
+    def reload_state(self, stale):
+        self.pvar.refresh(stale)
+        self.filter_cache.clear()
+
+    def _is_supported(self, cmd):
+        '''
+        Send ERROR_NOT_SUPPORTED and return False if the loaded package
+        databases can't answer cmd
+        '''
+        if cmd in self.pvar.unsupported_commands:
+            self.error(ERROR_NOT_SUPPORTED,
+                       "%s is not available with these package databases" %
+                       cmd, exit=False)
+            return False
+        return True
+
     def _package(self, cpv, info=None):
         desc = self._get_metadata(cpv, ["DESCRIPTION"])[0]
         if not info:
@@ -843,6 +1136,10 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
             self.category("", cat_id, name, summary, icon)
 
     def depends_on(self, filters, pkgs, recursive):
+        import _emerge.AtomArg
+        import _emerge.create_depgraph_params
+        import _emerge.depgraph
+
         # TODO: use only myparams ?
         # TODO: improve error management / info
 
@@ -851,6 +1148,9 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         # - free: ok
         # - newest: ignored because only one version of a package is installed
 
+        if not self._is_supported('depends-on'):
+            return
+
         self.status(STATUS_INFO)
         self.allow_cancel(True)
         self.percentage(None)
@@ -969,7 +1269,7 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
                 self._get_size(cpv)
             )
 
-            self.percentage(percentage)
+            self.progress(progress)
 
         self.percentage(100)
 
@@ -994,9 +1294,9 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
                            " packages")
                 continue
 
-            self.files(pkg, ';'.join(sorted(self._get_file_list(cpv))))
+            self.files(pkg, sorted(self._get_file_list(cpv)))
 
-            self.percentage(percentage)
+            self.progress(progress)
 
         self.percentage(100)
 
@@ -1015,7 +1315,7 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
                 except InvalidAtom:
                     continue
 
-            self.percentage(percentage)
+            self.progress(progress)
 
         self.percentage(100)
 
@@ -1028,6 +1328,10 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         Adds a dummy entry for gentoo-x86 official tree even though it appears
         in layman's listing nowadays.
         """
+        import layman.config
+        import layman.db
+        import layman.remotedb
+
         self.status(STATUS_INFO)
         self.allow_cancel(True)
         self.percentage(None)
@@ -1057,6 +1361,9 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         # - free: ok
         # - newest: ignored because only one version of a package is installed
 
+        if not self._is_supported('required-by'):
+            return
+
         self.status(STATUS_RUNNING)
         self.allow_cancel(True)
         self.percentage(None)
@@ -1138,6 +1445,8 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
             )
 
     def get_updates(self, filters):
+        from portage._sets.base import InternalPackageSet
+
         # NOTES:
         # because of a lot of things related to Gentoo,
         # only world and system packages are can be listed as updates
@@ -1155,6 +1464,9 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         # - free: ok
         # - newest: ok
 
+        if not self._is_supported('get-updates'):
+            return
+
         self.status(STATUS_INFO)
         self.allow_cancel(True)
         self.percentage(None)
@@ -1268,6 +1580,10 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
 
     def _install_packages(self, only_trusted, pkgs, simulate=False,
                           only_download=False):
+        import _emerge.Scheduler
+        import _emerge.create_depgraph_params
+        import _emerge.depgraph
+
         # NOTES:
         # can't install an already installed packages
         # even if it happens to be needed in Gentoo but probably not this API
@@ -1359,6 +1675,10 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         self._signal_config_update()
 
     def refresh_cache(self, force):
+        import _emerge.actions
+        import layman.config
+        import layman.db
+
         # NOTES: can't manage progress even if it could be better
         # TODO: do not wait for exception, check timestamp
         # TODO: message if overlay repo has changed (layman)
@@ -1389,10 +1709,19 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         finally:
             self._unblock_output()
 
+        # ebuilds edited in place in an overlay don't change the stamps
+        # of the trees, a forced refresh checks every package again
+        if force:
+            self.pvar.update(force=True)
+
     def remove_packages(self, transaction_flags, pkgs, allowdep, autoremove):
         return self._remove_packages(transaction_flags, pkgs, allowdep, autoremove)
 
     def _remove_packages(self, transaction_flags, pkgs, allowdep, autoremove):
+        import _emerge.Package
+        import _emerge.Scheduler
+        from portage._sets.base import InternalPackageSet
+
         # TODO: every to-be-removed pkg should emit self.package()
         #       see around _emerge.Scheduler.Scheduler
         self.status(STATUS_RUNNING)
@@ -1516,6 +1845,10 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         self._elog_messages = []
 
     def repo_enable(self, repoid, enable):
+        import layman.config
+        import layman.db
+        import layman.remotedb
+
         # NOTES: use layman API >= 1.2.3
         self.status(STATUS_INFO)
         self.allow_cancel(True)
@@ -1569,35 +1902,41 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         self.status(STATUS_QUERY)
         self.allow_cancel(True)
 
-        cp_list = self._get_all_cp(filters)
-        progress = PackagekitProgress(compute_equal_steps(cp_list))
-        self.percentage(progress.percent)
-
-        reg_expr = []
-        for pkg in pkgs:
-            reg_expr.append("^" + re.escape(pkg) + "$")
-        reg_expr = "|".join(reg_expr)
-
+        # pkgs are either cat/pkg or pkg
         # specifications says "be case sensitive"
-        s = re.compile(reg_expr)
+        names = self._get_cp_names(filters)
+        progress = PackagekitProgress(compute_equal_steps(pkgs))
+        self.percentage(progress.percent)
 
-        for percentage, cp in izip(progress, cp_list):
-            if s.match(cp):
+        found = set()
+        for percentage, pkg in izip(progress, pkgs):
+            for cp in names.get(pkg, ()):
+                # pkg and cat/pkg may both be asked for
+                if cp in found:
+                    continue
+                found.add(cp)
                 for cpv in self._get_all_cpv(cp, filters):
                     self._package(cpv)
 
-            self.percentage(percentage)
+            self.progress(progress)
 
         self.percentage(100)
 
     def search_details(self, filters, keys):
-        # NOTES: very bad performance
         self.status(STATUS_QUERY)
         self.allow_cancel(True)
 
         cp_list = self._get_all_cp(filters)
         search_list = self._get_search_list(keys)
 
+        # the words of the package index give the cpv that may match,
+        # only them are checked
+        candidates = None
+        if self.pvar.index is not None:
+            candidates = self.pvar.index.search(keys)
+        if candidates is not None:
+            cp_list = [cp for cp in cp_list if cp in candidates]
+
         progress = PackagekitProgress(compute_equal_steps(cp_list))
         self.percentage(progress.percent)
 
@@ -1610,21 +1949,24 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
             # because some cpv are going to be filtered by search conditions
             # and newest filter could be alterated
             for cpv in self._get_all_cpv(cp, filters, filter_newest=False):
+                if candidates is not None and cpv not in candidates[cp]:
+                    continue
                 match = True
                 metadata = self._get_metadata(
                     cpv, ["DESCRIPTION", "HOMEPAGE", "IUSE", "LICENSE",
                           "repository", "SLOT", "EAPI", "KEYWORDS"],
                     in_dict=True
                 )
-                # update LICENSE to correspond to system settings
-                metadata["LICENSE"] = self._get_real_license_str(cpv, metadata)
+                # LICENSE corresponding to system settings, costly, only
+                # computed if the other keys don't match
+                license_ = None
                 for s in search_list:
-                    found = False
-                    for x in metadata:
-                        if s.search(metadata[x]):
-                            found = True
-                            break
-                    if not found:
+                    if any(s.search(metadata[x]) for x in metadata
+                           if x != "LICENSE"):
+                        continue
+                    if license_ is None:
+                        license_ = self._get_real_license_str(cpv, metadata)
+                    if not s.search(license_):
                         match = False
                         break
                 if match:
@@ -1636,7 +1978,7 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
             for cpv in cpv_list:
                 self._package(cpv)
 
-            self.percentage(percentage)
+            self.progress(progress)
 
         self.percentage(100)
 
@@ -1677,27 +2019,28 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
                         self._package(cpv)
                         break
 
-            self.percentage(percentage)
+            self.progress(progress)
 
         self.percentage(100)
 
     def search_group(self, filters, groups):
-        # TODO: filter unknown groups before searching ? (optimization)
         self.status(STATUS_QUERY)
         self.allow_cancel(True)
 
-        cp_list = self._get_all_cp(filters)
+        # only the cps of the asked groups, unknown groups have none
+        group_cps = self._get_group_cps(filters)
+        cp_list = []
+        for group in sorted(set(groups), key=groups.index):
+            cp_list.extend(group_cps.get(group, ()))
 
         progress = PackagekitProgress(compute_equal_steps(cp_list))
         self.percentage(progress.percent)
 
         for percentage, cp in izip(progress, cp_list):
-            for group in groups:
-                if self._get_pk_group(cp) == group:
-                    for cpv in self._get_all_cpv(cp, filters):
-                        self._package(cpv)
+            for cpv in self._get_all_cpv(cp, filters):
+                self._package(cpv)
 
-            self.percentage(percentage)
+            self.progress(progress)
 
         self.percentage(100)
 
@@ -1753,7 +2096,7 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
                 for cpv in self._get_all_cpv(cp, filters):
                     self._package(cpv)
 
-            self.percentage(percentage)
+            self.progress(progress)
 
         self.percentage(100)
 
@@ -1768,6 +2111,10 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
 
     def _update_packages(self, only_trusted, pkgs, simulate=False,
                          only_download=False):
+        import _emerge.Scheduler
+        import _emerge.create_depgraph_params
+        import _emerge.depgraph
+
         # TODO: manage errors
         # TODO: manage config file updates
         # TODO: every updated pkg should emit self.package()
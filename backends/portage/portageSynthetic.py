@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# This file contains the stand-ins for the portage settings and package
+# databases used by portageBackend.py when PK_BACKEND_SYNTHETIC is set,
+# it is only imported then.
+#
+
+import os
+from collections import defaultdict
+
+from packagekit import synthetic
+try:
+    from packagekit.index import INSTALLED
+except ImportError:
+    # python built without sqlite, there is no index to fill
+    INSTALLED = None
+
+import portage
+import portage.dep
+
+
+def bridge(base):
+    """
+    Return a bridge serving the universe asked for with PK_BACKEND_SYNTHETIC.
+    @param base: the PortageBridge class of the backend
+    """
+    universe = synthetic.PackagekitSyntheticUniverse.from_environment()
+    cls = type('SyntheticPortageBridge', (SyntheticPortageBridgeMixin, base), {})
+    return cls(universe)
+
+
+class SyntheticPortageSettings(dict):
+
+    '''
+    The part of portage.config used by the backend, for a synthetic
+    universe.
+    '''
+
+    def __init__(self, universe):
+        dict.__init__(self, {
+            'ROOT': '/',
+            'PORTDIR': '/nonexistent/portage',
+            'DISTDIR': '/nonexistent/distfiles',
+            'ACCEPT_KEYWORDS': 'amd64',
+            'ACCEPT_LICENSE': '*',
+            'CONFIG_PROTECT': '',
+            'PORTAGE_ELOG_SYSTEM': '',
+            'USE': '',
+        })
+        self.categories = universe.categories
+        self.pkeywordsdict = {}
+        self.free_licenses = synthetic.FREE_LICENSES
+
+    def _accepted(self, license_):
+        accepted = False
+        for token in self['ACCEPT_LICENSE'].split():
+            negated = token.startswith('-')
+            token = token.lstrip('-')
+            if token == '*' or token == license_ or \
+               (token == '@FSF-APPROVED' and license_ in self.free_licenses):
+                accepted = not negated
+        return accepted
+
+    def _getMissingLicenses(self, cpv, metadata):
+        licenses = set(metadata['LICENSE'].split()) - \
+            set(['||', '(', ')', 'ssl?'])
+        return [x for x in sorted(licenses) if not self._accepted(x)]
+
+
+class SyntheticPortageDbapi(object):
+
+    '''
+    The part of vardbapi and portdbapi used by the backend, for a synthetic
+    universe.
+    '''
+
+    _aux_cache_keys = set(['DESCRIPTION', 'HOMEPAGE', 'IUSE', 'KEYWORDS',
+                           'LICENSE', 'RDEPEND', 'SLOT', 'repository'])
+
+    def __init__(self, packages):
+        self._packages = {}
+        self._cp_list = defaultdict(list)
+        for pkg in packages:
+            self._packages[pkg.cpv] = pkg
+            self._cp_list[pkg.cp].append(pkg.cpv)
+
+    def cp_all(self):
+        return sorted(self._cp_list)
+
+    def cp_list(self, cp):
+        return list(self._cp_list.get(cp, []))
+
+    def cpv_all(self):
+        return list(self._packages)
+
+    def cpv_exists(self, cpv):
+        return cpv in self._packages
+
+    def match(self, atom):
+        if atom in self._cp_list:
+            return self.cp_list(atom)
+        cp = portage.dep.dep_getkey(atom)
+        return portage.dep.match_from_list(atom, self.cp_list(cp))
+
+    def visible(self, cpv_list):
+        return cpv_list
+
+    def aux_get(self, cpv, keys):
+        pkg = self._packages[cpv]
+        metadata = {
+            'DESCRIPTION': pkg.description,
+            'HOMEPAGE': pkg.homepage,
+            'IUSE': 'ssl',
+            'KEYWORDS': pkg.keywords,
+            'LICENSE': pkg.license,
+            'RDEPEND': ' '.join(pkg.depends),
+            'DEPEND': ' '.join(pkg.depends),
+            'RESTRICT': '',
+            'SIZE': str(pkg.size),
+            'SLOT': pkg.slot,
+            'USE': '',
+            'repository': pkg.repository,
+        }
+        return [metadata.get(key, '') for key in keys]
+
+    def getFetchMap(self, cpv, useflags=None):
+        pkg = self._packages[cpv]
+        filename = '%s-%s.tar.xz' % (pkg.name, pkg.version)
+        return {filename: (pkg.homepage + filename,)}
+
+    def getfetchsizes(self, cpv, useflags=None):
+        return {'%s.tar.xz' % cpv.split('/')[1]: self._packages[cpv].size}
+
+
+class SyntheticPortageBridgeMixin(object):
+
+    '''
+    PortageBridge methods serving a generated universe instead of the
+    system package databases, see packagekit.synthetic and bridge().
+    '''
+
+    # no dependency graph nor package sets are built for the universe
+    unsupported_commands = frozenset([
+        'depends-on', 'get-updates', 'required-by'])
+
+    def __init__(self, universe):
+        self.universe = universe
+        super(SyntheticPortageBridgeMixin, self).__init__()
+
+    def update(self, force=False):
+        self.settings = SyntheticPortageSettings(self.universe)
+        self.mtimedb = {}
+        self.portdb = SyntheticPortageDbapi(self.universe.packages)
+        self.vardb = SyntheticPortageDbapi(
+            [pkg for pkg in self.universe.packages if pkg.installed])
+        self._sync_index(force)
+        self.generation += 1
+
+    def stale(self):
+        return []
+
+    def _index_path(self):
+        try:
+            return os.environ['PK_PORTAGE_INDEX']
+        except KeyError:
+            return ':memory:'
+
+    def index_sources(self):
+        stamp = 'synthetic %d:%d' % (self.universe.size, self.universe.seed)
+        return {INSTALLED: stamp, 'tree': stamp}
+
+    def index_scan(self, source):
+        db = self.vardb if source == INSTALLED else self.portdb
+        return dict.fromkeys(db.cpv_all(), '')
+
+    def apply_settings(self, mapping):
+        self.settings.update(mapping)
+
+    def ebuild_settings(self, cpv, metadata):
+        return self.settings
+
+    def fetch_size(self, cpv, metadata):
+        return sum(self.portdb.getfetchsizes(cpv).values())
+
+    def contents(self, cpv):
+        return self.universe.contents(self.portdb._packages[cpv])
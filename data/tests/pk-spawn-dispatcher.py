@@ -39,6 +39,11 @@ class PackageKitYumBackend(PackageKitBaseBackend):
         if key == ['power manager']:
             self.package("polkit;0.0.1;i386;data", INFO_AVAILABLE, "PolicyKit daemon")
 
+    def search_details(self, filters, key):
+        # simulate a slow query
+        time.sleep(1)
+        self.package("polkit;0.0.1;i386;data", INFO_AVAILABLE, "PolicyKit daemon")
+
 def main():
     backend = PackageKitYumBackend('', lock=True)
     backend.dispatcher(sys.argv[1:])
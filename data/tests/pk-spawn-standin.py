@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Backend answering queries from an in-memory package list, used to replay
+# recorded sessions with packagekit.benchmark without a real package
+# database. PK_STANDIN_PACKAGES sets the number of packages.
+
+import sys
+import os
+
+sys.path.insert(0,os.path.join(os.getcwd(), 'lib', 'python'))
+
+from packagekit.backend import *
+from packagekit.output import PackageKitBufferedOutput
+
+CATEGORIES = ['app-editors', 'dev-lang', 'dev-libs', 'media-sound',
+              'net-misc', 'sys-apps', 'x11-libs', 'games-action']
+
+class PackageKitStandInBackend(PackageKitBaseBackend):
+
+    output_class = PackageKitBufferedOutput
+
+    def __init__(self, args):
+        PackageKitBaseBackend.__init__(self, args)
+        count = int(os.environ.get('PK_STANDIN_PACKAGES', '2000'))
+        self.packages = []
+        for i in range(count):
+            name = '%s/package%d' % (CATEGORIES[i % len(CATEGORIES)], i)
+            package_id = get_package_id(name, '1.%d' % (i % 10), 'x86', 'gentoo')
+            info = INFO_INSTALLED if i % 7 == 0 else INFO_AVAILABLE
+            summary = 'Package number %d for the %s category' % (
+                i, CATEGORIES[i % len(CATEGORIES)])
+            self.packages.append((name, package_id, info, summary))
+        self.by_id = dict((p[1], p) for p in self.packages)
+
+    def _emit_all(self, filters, match):
+        for name, package_id, info, summary in self.packages:
+            if FILTER_INSTALLED in filters and info != INFO_INSTALLED:
+                continue
+            if FILTER_NOT_INSTALLED in filters and info == INFO_INSTALLED:
+                continue
+            if match(name, summary):
+                self.package(package_id, info, summary)
+
+    def get_packages(self, filters):
+        self.status(STATUS_QUERY)
+        self._emit_all(filters, lambda name, summary: True)
+
+    def resolve(self, filters, values):
+        self.status(STATUS_QUERY)
+        wanted = set(values)
+        self._emit_all(filters, lambda name, summary:
+                       name in wanted or name.split('/')[1] in wanted)
+
+    def search_name(self, filters, values):
+        self.status(STATUS_QUERY)
+        self._emit_all(filters, lambda name, summary:
+                       all(value in name for value in values))
+
+    def search_details(self, filters, values):
+        self.status(STATUS_QUERY)
+        self._emit_all(filters, lambda name, summary:
+                       all(value in name or value in summary
+                           for value in values))
+
+    def get_details(self, package_ids):
+        self.status(STATUS_INFO)
+        for package_id in package_ids:
+            if package_id not in self.by_id:
+                self.error(ERROR_PACKAGE_NOT_FOUND,
+                           "package %s not found" % package_id, exit=False)
+                continue
+            name, package_id, info, summary = self.by_id[package_id]
+            self.details(package_id, summary, 'GPL-2', GROUP_UNKNOWN,
+                         summary, 'http://example.org/', 1024)
+
+    def get_files(self, package_ids):
+        self.status(STATUS_INFO)
+        for package_id in package_ids:
+            name = split_package_id(package_id)[0].split('/')[1]
+            files = ['/usr/bin/%s' % name, '/usr/share/doc/%s/README' % name]
+            self.files(package_id, ';'.join(files))
+
+def main():
+    backend = PackageKitStandInBackend('')
+    backend.dispatcher(sys.argv[1:])
+
+if __name__ == "__main__":
+    main()
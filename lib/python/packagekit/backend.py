@@ -24,15 +24,43 @@
 # imports
 from __future__ import print_function
 
+import cProfile
+import re
+import resource
+import signal
 import sys
+import threading
+import time
 import traceback
 import os.path
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import _thread as thread
+except ImportError:
+    import thread
 
 from .enums import *
+from . import framing
+from .filter import PackagekitFilterFlags
+from .output import PackageKitLineOutput, PackageKitBlockOutput, \
+    PackageKitRecordingOutput
 
 PACKAGE_IDS_DELIM = '&'
 FILENAME_DELIM = '|'
 
+# argument types used in the command table, see register_command()
+ARG_STRING = 'string'
+ARG_ENUM = 'enum'
+ARG_BOOL = 'bool'
+ARG_FILTERS = 'filters'
+ARG_FLAGS = 'flags'
+ARG_PACKAGE_IDS = 'package-ids'
+ARG_VALUES = 'values'
+ARG_FILES = 'files'
+
 def _to_unicode(txt, encoding='utf-8'):
     if isinstance(txt, str):
         if not isinstance(txt, str):
@@ -46,6 +74,11 @@ def _to_utf8(txt, errors='replace'):
         return txt.encode('utf-8', errors=errors)
     return str(txt)
 
+def _to_bytes(txt):
+    if isinstance(txt, bytes):
+        return txt
+    return txt.encode('utf-8', 'replace')
+
 class PkError(Exception):
     def __init__(self, code, details):
         self.code = code
@@ -55,10 +88,41 @@ class PkError(Exception):
 
 class PackageKitBaseBackend:
 
+    # command name -> (method name, argument parsers)
+    _commands = {}
+
+    # output channel used to send signals, PackageKitLineOutput flushes
+    # every single line while PackageKitBufferedOutput sends them in batches
+    output_class = PackageKitLineOutput
+
+    # number of commands the dispatcher reads ahead from stdin
+    command_queue_size = 64
+
+    # commands that only read the package databases and can safely run
+    # in parallel, used when concurrent_workers is not zero
+    read_only_commands = frozenset()
+    concurrent_workers = 0
+
+    # minimum number of seconds between two progress signals of one kind,
+    # changes in between are dropped but the final value is always sent
+    progress_interval = 0.1
+
+    # bytes of file names sent in one 'files' signal when files() is given
+    # an iterable, the list of a big package is split across signals
+    files_chunk_size = 65536
+
     def __init__(self, cmds):
         # Setup a custom exception handler
         installExceptionHandler(self)
         self.cmds = cmds
+        self._main_transaction = _Transaction(self.output_class())
+        self._encode = _encode_line
+        self._local = threading.local()
+        self._recording = None
+        self._profile = None
+        self._profile_dump = None
+        self._profile_count = 0
+        self._remaining_time = False
         self._locked = False
         self.lang = "C"
         self.has_network = False
@@ -66,7 +130,11 @@ class PackageKitBaseBackend:
         self.background = False
         self.interactive = False
         self.cache_age = 0
-        self.percentage_old = 0
+
+        # guards the profile log written by the worker threads and the
+        # cancel state shared with the stdin reader thread
+        self._state_lock = threading.Lock()
+        self._cancelling = False
 
         # try to get LANG
         try:
@@ -107,6 +175,37 @@ class PackageKitBaseBackend:
         except KeyError as e:
             pass
 
+        # record the session for packagekit.benchmark
+        try:
+            self._recording = open(os.environ['PK_BACKEND_RECORD'], 'a')
+            self.set_output(self._main_transaction.output)
+        except KeyError as e:
+            pass
+
+        # length prefixed records, if the daemon asked for them
+        try:
+            if os.environ[framing.FRAMING_ENV] == framing.FRAMING_LENGTH:
+                self._encode = framing.encode_record
+                self.set_output(self._main_transaction.output)
+                self._main_transaction.output.write(framing.HELLO, flush=True)
+        except KeyError as e:
+            pass
+
+        # remaining-time records, if the daemon can parse them
+        try:
+            if os.environ['PK_BACKEND_REMAINING_TIME'] == 'TRUE':
+                self._remaining_time = True
+        except KeyError as e:
+            pass
+
+        # per command resource usage and state reload times, and cProfile
+        # dumps if asked for
+        try:
+            self._profile = open(os.environ['PK_BACKEND_PROFILE'], 'a')
+            self._profile_dump = os.environ.get('PK_BACKEND_PROFILE_DUMP')
+        except KeyError as e:
+            pass
+
     def doLock(self):
         ''' Generic locking, overide and extend in child class'''
         self._locked = True
@@ -118,25 +217,90 @@ class PackageKitBaseBackend:
     def isLocked(self):
         return self._locked
 
+    def set_output(self, output):
+        '''
+        Replace the output channel, pending records are sent first
+        @param output: a PackageKitLineOutput compatible object
+        '''
+        self._main_transaction.output.flush()
+        if isinstance(output, PackageKitRecordingOutput):
+            output = output.output
+        if self._recording is not None:
+            output = PackageKitRecordingOutput(output, self._recording,
+                self._encode is framing.encode_record)
+        self._main_transaction.output = output
+
+    def flush_output(self):
+        '''
+        Make sure every record emitted so far has reached the daemon
+        '''
+        self._get_transaction().output.flush()
+
+    def _get_transaction(self):
+        return getattr(self._local, 'transaction', self._main_transaction)
+
+    def _signal(self, name, fields=(), flush=False):
+        transaction = self._get_transaction()
+        record = self._encode(name, fields)
+        transaction.records += 1
+        transaction.bytes += len(record)
+        transaction.output.write(record, flush)
+
     def percentage(self, percent=None):
         '''
         Write progress percentage
         @param percent: Progress percentage (int preferred)
         '''
+        transaction = self._get_transaction()
         if percent == None:
-            sys.stdout.write(_to_utf8("no-percentage-updates\n"))
-        elif percent == 0 or percent > self.percentage_old:
-            sys.stdout.write(_to_utf8("percentage\t%i\n" % percent))
-            self.percentage_old = percent
-        sys.stdout.flush()
+            self._signal("no-percentage-updates")
+        elif percent > transaction.percentage_old or \
+             (percent == 0 and transaction.percentage_old != 0):
+            if 0 < percent < 100 and not self._progress_due('percentage', transaction):
+                return
+            self._signal("percentage", (int(percent),))
+            transaction.percentage_old = percent
 
     def speed(self, bps=0):
         '''
         Write progress speed
         @param bps: Progress speed (int, bytes per second)
         '''
-        sys.stdout.write(_to_utf8("speed\t%i\n" % bps))
-        sys.stdout.flush()
+        transaction = self._get_transaction()
+        if bps == transaction.speed_old:
+            return
+        if bps != 0 and not self._progress_due('speed', transaction):
+            return
+        self._signal("speed", (int(bps),))
+        transaction.speed_old = bps
+
+    def remaining(self, seconds=None):
+        '''
+        Write the predicted remaining time, only sent if the daemon set
+        PK_BACKEND_REMAINING_TIME=TRUE
+        @param seconds: seconds until the end of the transaction, None
+        if unknown
+        '''
+        if not self._remaining_time or seconds is None:
+            return
+        transaction = self._get_transaction()
+        seconds = int(seconds)
+        if seconds == transaction.remaining_old:
+            return
+        if seconds != 0 and not self._progress_due('remaining-time', transaction):
+            return
+        self._signal("remaining-time", (seconds,))
+        transaction.remaining_old = seconds
+
+    def progress(self, progress):
+        '''
+        Write the percentage, speed and remaining time of a
+        PackagekitProgress
+        '''
+        self.percentage(progress.percent)
+        if progress.bps is not None:
+            self.speed(int(progress.bps))
+        self.remaining(progress.remaining)
 
     def item_progress(self, package_id, status, percent=None):
         '''
@@ -144,8 +308,26 @@ class PackageKitBaseBackend:
         @param package_id: The package ID name, e.g. openoffice-clipart;2.6.22;ppc64;fedora
         @param percent: percentage of the current item (int preferred)
         '''
-        sys.stdout.write(_to_utf8("item-progress\t%s\t%s\t%i\n" % (package_id, status, percent)))
-        sys.stdout.flush()
+        transaction = self._get_transaction()
+        old = transaction.item_progress_old.get(package_id)
+        if old == (status, percent):
+            return
+        if old is not None and old[0] == status and percent < 100 and \
+           not self._progress_due(('item-progress', package_id), transaction):
+            return
+        self._signal("item-progress", (package_id, status, int(percent)))
+        transaction.item_progress_old[package_id] = (status, percent)
+
+    def _progress_due(self, key, transaction):
+        '''
+        Return True if the progress signal key can be sent now, callers
+        always send the values that end a progress (100, 0 bytes/s)
+        '''
+        now = time.time()
+        if now - transaction.progress_sent.get(key, 0) < self.progress_interval:
+            return False
+        transaction.progress_sent[key] = now
+        return True
 
     def error(self, err, description, exit=True):
         '''
@@ -154,13 +336,14 @@ class PackageKitBaseBackend:
         @param description: Error description
         @param exit: exit application with rc = 1, if true
         '''
-        # unlock before we emit if we are going to exit
-        if exit and self.isLocked():
+        # unlock before we emit if we are going to exit, a worker thread
+        # leaves it to the dispatcher, other commands may still be running
+        if exit and self._get_transaction() is self._main_transaction and \
+           self.isLocked():
             self.unLock()
 
         # this should be fast now
-        sys.stdout.write(_to_utf8("error\t%s\t%s\n" % (err, description)))
-        sys.stdout.flush()
+        self._signal("error", (err, description), flush=True)
         if exit:
             # Paradoxically, we don't want to print "finished" to stdout here.
             # Python takes an _enormous_ amount of time to exit, and leaves a
@@ -174,8 +357,7 @@ class PackageKitBaseBackend:
         send 'message' signal
         @param typ: MESSAGE_BROKEN_MIRROR
         '''
-        sys.stdout.write(_to_utf8("message\t%s\t%s\n" % (typ, msg)))
-        sys.stdout.flush()
+        self._signal("message", (typ, msg))
 
     def package(self, package_id, status, summary):
         '''
@@ -184,8 +366,7 @@ class PackageKitBaseBackend:
         @param package_id: The package ID name, e.g. openoffice-clipart;2.6.22;ppc64;fedora
         @param summary: The package Summary
         '''
-        sys.stdout.write(_to_utf8("package\t%s\t%s\t%s\n" % (status, package_id, summary)))
-        sys.stdout.flush()
+        self._signal("package", (status, package_id, summary))
 
     def media_change_required(self, mtype, id, text):
         '''
@@ -194,8 +375,7 @@ class PackageKitBaseBackend:
         @param id: the localised label of the media
         @param text: the localised text describing the media
         '''
-        sys.stdout.write(_to_utf8("media-change-required\t%s\t%s\t%s\n" % (mtype, id, text)))
-        sys.stdout.flush()
+        self._signal("media-change-required", (mtype, id, text))
 
     def distro_upgrade(self, dtype, name, summary):
         '''
@@ -204,16 +384,14 @@ class PackageKitBaseBackend:
         @param name: The distro name, e.g. "fedora-9"
         @param summary: The localised distribution name and description
         '''
-        sys.stdout.write(_to_utf8("distro-upgrade\t%s\t%s\t%s\n" % (dtype, name, summary)))
-        sys.stdout.flush()
+        self._signal("distro-upgrade", (dtype, name, summary))
 
     def status(self, state):
         '''
         send 'status' signal
         @param state: STATUS_DOWNLOAD, STATUS_INSTALL, STATUS_UPDATE, STATUS_REMOVE, STATUS_WAIT
         '''
-        sys.stdout.write(_to_utf8("status\t%s\n" % state))
-        sys.stdout.flush()
+        self._signal("status", (state,), flush=True)
 
     def repo_detail(self, repoid, name, state):
         '''
@@ -221,16 +399,14 @@ class PackageKitBaseBackend:
         @param repoid: The repo id tag
         @param state: false is repo is disabled else true.
         '''
-        sys.stdout.write(_to_utf8("repo-detail\t%s\t%s\t%s\n" % (repoid, name, _bool_to_string(state))))
-        sys.stdout.flush()
+        self._signal("repo-detail", (repoid, name, bool(state)))
 
     def data(self, data):
         '''
         send 'data' signal:
         @param data:  The current worked on package
         '''
-        sys.stdout.write(_to_utf8("data\t%s\n" % data))
-        sys.stdout.flush()
+        self._signal("data", (data,))
 
     def details(self, package_id, summary, package_license, group, desc, url, bytes):
         '''
@@ -243,16 +419,34 @@ class PackageKitBaseBackend:
         @param url: The upstream project homepage
         @param bytes: The size of the package, in bytes
         '''
-        sys.stdout.write(_to_utf8("details\t%s\t%s\t%s\t%s\t%s\t%s\t%ld\n" % (package_id, summary, package_license, group, desc, url, bytes)))
-        sys.stdout.flush()
+        self._signal("details", (package_id, summary, package_license, group, desc, url, int(bytes)))
 
     def files(self, package_id, file_list):
         '''
         Send 'files' signal
-        @param file_list: List of the files in the package, separated by ';'
-        '''
-        sys.stdout.write(_to_utf8("files\t%s\t%s\n" % (package_id, file_list)))
-        sys.stdout.flush()
+        @param file_list: List of the files in the package, separated by ';',
+        or an iterable of file names. An iterable is consumed as it is sent,
+        in 'files' signals of at most files_chunk_size bytes each.
+        '''
+        if isinstance(file_list, (str, type(u''))):
+            self._signal("files", (package_id, file_list))
+            return
+        chunk = []
+        size = 0
+        sent = False
+        for name in file_list:
+            # the size of the name once encoded, not its length in
+            # characters
+            length = len(_to_bytes(name))
+            if chunk and size + length > self.files_chunk_size:
+                self._signal("files", (package_id, chunk))
+                chunk = []
+                size = 0
+                sent = True
+            chunk.append(name)
+            size += length + 1
+        if chunk or not sent:
+            self._signal("files", (package_id, chunk))
 
     def category(self, parent_id, cat_id, name, summary, icon):
         '''
@@ -263,15 +457,18 @@ class PackageKitBaseBackend:
         summery   : a summary of the category in current locale.
         icon      : an icon name to represent the category
         '''
-        sys.stdout.write(_to_utf8("category\t%s\t%s\t%s\t%s\t%s\n" % (parent_id, cat_id, name, summary, icon)))
-        sys.stdout.flush()
+        self._signal("category", (parent_id, cat_id, name, summary, icon))
 
     def finished(self):
         '''
         Send 'finished' signal
         '''
-        sys.stdout.write(_to_utf8("finished\n"))
-        sys.stdout.flush()
+        transaction = self._get_transaction()
+        # the daemon considers the transaction done, don't cancel it now
+        transaction.busy = False
+        self._signal("finished", flush=True)
+        # the next command starts its progress from scratch
+        transaction.reset_progress()
 
     def update_detail(self, package_id, updates, obsoletes, vendor_url, bugzilla_url, cve_url, restart, update_text, changelog, state, issued, updated):
         '''
@@ -289,8 +486,7 @@ class PackageKitBaseBackend:
         @param issued:
         @param updated:
         '''
-        sys.stdout.write(_to_utf8("updatedetail\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (package_id, updates, obsoletes, vendor_url, bugzilla_url, cve_url, restart, update_text, changelog, state, issued, updated)))
-        sys.stdout.flush()
+        self._signal("updatedetail", (package_id, updates, obsoletes, vendor_url, bugzilla_url, cve_url, restart, update_text, changelog, state, issued, updated))
 
     def require_restart(self, restart_type, details):
         '''
@@ -298,20 +494,16 @@ class PackageKitBaseBackend:
         @param restart_type: RESTART_SYSTEM, RESTART_APPLICATION, RESTART_SESSION
         @param details: Optional details about the restart
         '''
-        sys.stdout.write(_to_utf8("requirerestart\t%s\t%s\n" % (restart_type, details)))
-        sys.stdout.flush()
+        self._signal("requirerestart", (restart_type, details))
 
     def allow_cancel(self, allow):
         '''
         send 'allow-cancel' signal:
         @param allow:  Allow the current process to be aborted.
         '''
-        if allow:
-            data = 'true'
-        else:
-            data = 'false'
-        sys.stdout.write(_to_utf8("allow-cancel\t%s\n" % data))
-        sys.stdout.flush()
+        transaction = self._get_transaction()
+        transaction.can_cancel = bool(allow)
+        self._signal("allow-cancel", (transaction.can_cancel,))
 
     def repo_signature_required(self, package_id, repo_name, key_url, key_userid, key_id, key_fingerprint, key_timestamp, sig_type):
         '''
@@ -325,10 +517,9 @@ class PackageKitBaseBackend:
         @param key_timestamp:   Key timestamp
         @param sig_type:        Key type (GPG)
         '''
-        sys.stdout.write(_to_utf8("repo-signature-required\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
+        self._signal("repo-signature-required", (
             package_id, repo_name, key_url, key_userid, key_id, key_fingerprint, key_timestamp, sig_type
-            )))
-        sys.stdout.flush()
+            ))
 
     def eula_required(self, eula_id, package_id, vendor_name, license_agreement):
         '''
@@ -338,10 +529,9 @@ class PackageKitBaseBackend:
         @param vendor_name:     Name of the vendor that wrote the EULA
         @param license_agreement: The license text
         '''
-        sys.stdout.write(_to_utf8("eula-required\t%s\t%s\t%s\t%s\n" % (
+        self._signal("eula-required", (
             eula_id, package_id, vendor_name, license_agreement
-            )))
-        sys.stdout.flush()
+            ))
 
 #
 # Backend Action Methods
@@ -570,6 +760,37 @@ class PackageKitBaseBackend:
         '''
         return False
 
+    def stale_state(self):
+        '''
+        Return the names of the parts of the loaded state that changed on
+        disk since they were loaded.
+        Backends keeping their package databases loaded between commands
+        overload this and reload_state.
+        '''
+        return []
+
+    def reload_state(self, stale):
+        '''
+        Reload the state reported by stale_state
+        @param stale: what stale_state returned
+        '''
+        pass
+
+    def _refresh_state(self, pool):
+        stale = self.stale_state()
+        if not stale:
+            return
+        # commands still running use the old state
+        if pool is not None:
+            pool.wait()
+        started = time.time()
+        self.reload_state(stale)
+        if self._profile is not None:
+            with self._state_lock:
+                self._profile.write('-\treload\twall=%.6f\tstale=%s\n' %
+                                    (time.time() - started, ','.join(stale)))
+                self._profile.flush()
+
     def run_command(self):
         '''
         interprete the command from the calling args (self.cmds)
@@ -579,170 +800,426 @@ class PackageKitBaseBackend:
         args = self.cmds[1:]
         self.dispatch_command(cmd, args)
 
+    @classmethod
+    def register_command(cls, name, method, *schema):
+        '''
+        Add or replace a command understood by dispatch_command()
+        @param name: the command name, e.g. 'get-packages'
+        @param method: the name of the method implementing the command
+        @param schema: one ARG_* type per command argument
+        '''
+        # don't add subclass commands to the parent class table
+        if '_commands' not in cls.__dict__:
+            cls._commands = dict(cls._commands)
+        cls._commands[name] = (method, tuple([_ARG_PARSERS[arg] for arg in schema]))
+
     def dispatch_command(self, cmd, args):
-        if cmd == 'download-packages':
-            directory = args[0]
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            self.download_packages(directory, package_ids)
-            self.finished()
-        elif cmd == 'depends-on':
-            filters = args[0].split(';')
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            recursive = _text_to_bool(args[2])
-            self.depends_on(filters, package_ids, recursive)
-            self.finished()
-        elif cmd == 'get-details':
-            package_ids = args[0].split(PACKAGE_IDS_DELIM)
-            self.get_details(package_ids)
-            self.finished()
-        elif cmd == 'get-details-local':
-            files = args[0].split(PACKAGE_IDS_DELIM)
-            self.get_details_local(files)
-            self.finished()
-        elif cmd == 'get-files':
-            package_ids = args[0].split(PACKAGE_IDS_DELIM)
-            self.get_files(package_ids)
-            self.finished()
-        elif cmd == 'get-packages':
-            filters = args[0].split(';')
-            self.get_packages(filters)
-            self.finished()
-        elif cmd == 'get-repo-list':
-            filters = args[0].split(';')
-            self.get_repo_list(filters)
-            self.finished()
-        elif cmd == 'required-by':
-            filters = args[0].split(';')
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            recursive = _text_to_bool(args[2])
-            self.required_by(filters, package_ids, recursive)
-            self.finished()
-        elif cmd == 'get-update-detail':
-            package_ids = args[0].split(PACKAGE_IDS_DELIM)
-            self.get_update_detail(package_ids)
-            self.finished()
-        elif cmd == 'get-distro-upgrades':
-            self.get_distro_upgrades()
-            self.finished()
-        elif cmd == 'get-updates':
-            filters = args[0].split(';')
-            self.get_updates(filters)
-            self.finished()
-        elif cmd == 'install-files':
-            transaction_flags = args[0].split(';')
-            files_to_inst = args[1].split(FILENAME_DELIM)
-            self.install_files(transaction_flags, files_to_inst)
-            self.finished()
-        elif cmd == 'install-packages':
-            transaction_flags = args[0].split(';')
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            self.install_packages(transaction_flags, package_ids)
-            self.finished()
-        elif cmd == 'install-signature':
-            sigtype = args[0]
-            key_id = args[1]
-            package_id = args[2]
-            self.install_signature(sigtype, key_id, package_id)
-            self.finished()
-        elif cmd == 'refresh-cache':
-            force = _text_to_bool(args[0])
-            self.refresh_cache(force)
-            self.finished()
-        elif cmd == 'remove-packages':
-            transaction_flags = args[0].split(';')
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            allowdeps = _text_to_bool(args[2])
-            autoremove = _text_to_bool(args[3])
-            self.remove_packages(transaction_flags, package_ids, allowdeps, autoremove)
-            self.finished()
-        elif cmd == 'repo-enable':
-            repoid = args[0]
-            state = _text_to_bool(args[1])
-            self.repo_enable(repoid, state)
-            self.finished()
-        elif cmd == 'repo-set-data':
-            repoid = args[0]
-            para = args[1]
-            value = args[2]
-            self.repo_set_data(repoid, para, value)
-            self.finished()
-        elif cmd == 'resolve':
-            filters = args[0].split(';')
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            self.resolve(filters, package_ids)
-            self.finished()
-        elif cmd == 'search-details':
-            filters = args[0].split(';')
-            values = _to_unicode(args[1]).split(PACKAGE_IDS_DELIM)
-            self.search_details(filters, values)
-            self.finished()
-        elif cmd == 'search-file':
-            filters = args[0].split(';')
-            values = args[1].split(PACKAGE_IDS_DELIM)
-            self.search_file(filters, values)
-            self.finished()
-        elif cmd == 'search-group':
-            filters = args[0].split(';')
-            values = args[1].split(PACKAGE_IDS_DELIM)
-            self.search_group(filters, values)
-            self.finished()
-        elif cmd == 'search-name':
-            filters = args[0].split(';')
-            values = _to_unicode(args[1]).split(PACKAGE_IDS_DELIM)
-            self.search_name(filters, values)
-            self.finished()
-        elif cmd == 'signature-install':
-            package = args[0]
-            self.repo_signature_install(package)
-            self.finished()
-        elif cmd == 'update-packages':
-            transaction_flags = args[0].split(';')
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            self.update_packages(transaction_flags, package_ids)
-            self.finished()
-        elif cmd == 'what-provides':
-            filters = args[0].split(';')
-            provides_type = args[1]
-            values = _to_unicode(args[2]).split(PACKAGE_IDS_DELIM)
-            self.what_provides(filters, provides_type, values)
-            self.finished()
-        elif cmd == 'set-locale':
-            code = args[0]
-            self.set_locale(code)
-            self.finished()
-        elif cmd == 'get-categories':
-            self.get_categories()
-            self.finished()
-        elif cmd == 'upgrade-system':
-            self.upgrade_system(args[0])
-            self.finished()
-        elif cmd == 'repair-system':
-            self.repair_system(args[0])
-            self.finished()
-        else:
+        try:
+            method, parsers = self._commands[cmd]
+        except KeyError:
             errmsg = "command '%s' is not known" % cmd
             self.error(ERROR_INTERNAL_ERROR, errmsg, exit=False)
             self.finished()
+            return
+        if self._profile is not None:
+            self._profile_command(cmd, method, parsers, args)
+        else:
+            self._call_command(method, parsers, args)
+
+    def _call_command(self, method, parsers, args):
+        try:
+            args = _parse_args(method, parsers, args)
+        except ValueError as e:
+            self.error(ERROR_INTERNAL_ERROR, str(e), exit=False)
+        else:
+            getattr(self, method)(*args)
+        self.finished()
+
+    def _profile_command(self, cmd, method, parsers, args):
+        '''
+        Run a command and append its wall and cpu time, peak memory usage,
+        records and bytes sent to the PK_BACKEND_PROFILE file
+        '''
+        transaction = self._get_transaction()
+        records, nbytes = transaction.records, transaction.bytes
+        profiler = None
+        if self._profile_dump:
+            profiler = cProfile.Profile()
+        # only count the thread running the command
+        who = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+        usage = resource.getrusage(who)
+        started = time.time()
+        try:
+            if profiler is not None:
+                profiler.runcall(self._call_command, method, parsers, args)
+            else:
+                self._call_command(method, parsers, args)
+        finally:
+            wall = time.time() - started
+            end = resource.getrusage(who)
+            cpu = max(0, end.ru_utime + end.ru_stime -
+                      usage.ru_utime - usage.ru_stime)
+            with self._state_lock:
+                self._profile_count += 1
+                count = self._profile_count
+                if profiler is not None:
+                    profiler.dump_stats(os.path.join(
+                        self._profile_dump, '%d-%s.prof' % (count, cmd)))
+                self._profile.write(
+                    '%d\t%s\twall=%.6f\tcpu=%.6f\tmaxrss=%d\trecords=%d\t'
+                    'bytes=%d\n' % (count, cmd, wall, cpu,
+                                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                    transaction.records - records,
+                                    transaction.bytes - nbytes))
+                self._profile.flush()
+
+    def _record_command(self, args):
+        if self._recording is not None:
+            self._main_transaction.output.command(args)
+
+    def _run_job(self, job):
+        '''
+        Run a read-only command from a worker thread, its signals are kept
+        in the job output until the dispatcher writes them out
+        '''
+        self._local.transaction = job.transaction
+        try:
+            self.dispatch_command(job.cmd, job.args)
+        except SystemExit as e:
+            # error() with exit=True
+            job.exit_code = e.code
+        except Exception:
+            typ, value, tb = sys.exc_info()
+            if not self.customTracebackHandler(typ):
+                self.error(ERROR_INTERNAL_ERROR, _format_exception(typ, value, tb), exit=False)
+                job.exit_code = 254
+        finally:
+            del self._local.transaction
+
+    def _write_job(self, job):
+        output = self._main_transaction.output
+        output.write(job.output.getvalue(), flush=True)
+
+    def _write_cancelled(self):
+        '''
+        End the command of a worker thread that was cancelled, whatever
+        it sends from now on is dropped
+        '''
+        self._local.transaction = _Transaction(PackageKitBlockOutput())
+        try:
+            self.error(ERROR_TRANSACTION_CANCELLED, 'the transaction was cancelled', exit=False)
+            self.finished()
+            self._write_job(self._local.transaction)
+        finally:
+            del self._local.transaction
+
+    def _run_command(self, cmd, args):
+        '''
+        Run a command on the main thread, where 'cancel' can interrupt it
+        '''
+        transaction = self._main_transaction
+        with self._state_lock:
+            transaction.busy = True
+            transaction.can_cancel = False
+        try:
+            self.dispatch_command(cmd, args)
+        except _TransactionCancelled:
+            self.error(ERROR_TRANSACTION_CANCELLED, 'the transaction was cancelled', exit=False)
+            self.finished()
+        finally:
+            with self._state_lock:
+                transaction.busy = False
+
+    def _control(self, line, pool):
+        '''
+        Called by the stdin reader for 'exit' and 'cancel' lines
+        '''
+        if line == 'exit':
+            # the running commands finish, the others never start
+            if pool is not None:
+                pool.drop_queued()
+            return
+        # the oldest command not finished yet is the one cancelled, the
+        # main thread only runs a command once the pool is idle
+        if pool is not None and pool.cancel():
+            return
+        with self._state_lock:
+            transaction = self._main_transaction
+            if transaction.busy and transaction.can_cancel and not self._cancelling:
+                self._cancelling = True
+                thread.interrupt_main()
+
+    def _handle_interrupt(self, signum, frame):
+        if not self._cancelling:
+            # ctrl-c
+            raise KeyboardInterrupt()
+        self._cancelling = False
+        # the command may have finished, or stopped allowing cancel, since
+        # the interrupt was sent
+        transaction = self._main_transaction
+        if transaction.busy and transaction.can_cancel:
+            raise _TransactionCancelled()
 
     def dispatcher(self, args):
+        pool = None
+        if self.concurrent_workers > 0 and self.read_only_commands:
+            pool = _WorkerPool(self, self.concurrent_workers,
+                               lambda: reader.stop())
+        reader = _CommandReader(self.command_queue_size,
+                                lambda line: self._control(line, pool))
+        # 'cancel' interrupts the command running on the main thread
+        signal.signal(signal.SIGINT, self._handle_interrupt)
+        reader.start()
+        # ctrl-c kills the backend wherever it lands, while reading or
+        # while running a command; the daemon cancels with SIGQUIT
+        try:
+            self._dispatch_loop(reader, pool, args)
+        except KeyboardInterrupt as e:
+            self.error(ERROR_PROCESS_KILL, 'process was killed by ctrl-c: %s' % str(e))
+
+        # unlock backend and exit, with the code of the read-only command
+        # that called error() with exit=True if any
+        if self.isLocked():
+            self.unLock()
+        self.flush_output()
+        if pool is not None and pool.exit_code is not None:
+            sys.exit(pool.exit_code)
+        sys.exit(0)
+
+    def _dispatch_loop(self, reader, pool, args):
         if len(args) > 0:
-            self.dispatch_command(args[0], args[1:])
+            self._record_command(args)
+            self._refresh_state(pool)
+            self._run_command(args[0], args[1:])
         while True:
-            try:
-                line = sys.stdin.readline().strip('\n')
-            except IOError as e:
-                self.error(ERROR_TRANSACTION_CANCELLED, 'could not read from stdin: %s' % str(e))
-            except KeyboardInterrupt as e:
-                self.error(ERROR_PROCESS_KILL, 'process was killed by ctrl-c: %s' % str(e))
-            if not line or line == 'exit':
+            line = reader.get()
+            # after 'exit' only the running commands are left to finish
+            if reader.exiting:
+                break
+            if pool is not None and pool.exit_code is not None:
+                break
+            if isinstance(line, EnvironmentError):
+                self.error(ERROR_TRANSACTION_CANCELLED, 'could not read from stdin: %s' % str(line))
+            if line is None:
                 break
             args = line.split('\t')
-            self.dispatch_command(args[0], args[1:])
+            self._record_command(args)
+            # the dispatcher stays loaded, pick up changes made meanwhile
+            self._refresh_state(pool)
+            if reader.exiting:
+                break
+            if pool is not None and args[0] in self.read_only_commands:
+                pool.submit(args[0], args[1:])
+                continue
+            # anything else must not run alongside the read-only commands
+            if pool is not None:
+                pool.wait()
+                if pool.exit_code is not None or reader.exiting:
+                    break
+            self._run_command(args[0], args[1:])
+
+        if pool is not None:
+            pool.wait()
+
+class _TransactionCancelled(BaseException):
+    '''
+    Raised in the main thread by 'cancel', not an Exception so the
+    handlers of the backends let it through
+    '''
 
-        # unlock backend and exit with success
-        if self.isLocked():
-            self.unLock()
-        sys.exit(0)
+class _Transaction(object):
+    '''
+    Per command state: the channel its signals are written to, the last
+    progress sent and whether the command can be cancelled
+    '''
+
+    def __init__(self, output):
+        self.output = output
+        self.records = 0
+        self.bytes = 0
+        self.busy = False
+        self.can_cancel = False
+        self.reset_progress()
+
+    def reset_progress(self):
+        # -1 so the first 0 still goes out
+        self.percentage_old = -1
+        self.speed_old = None
+        self.remaining_old = None
+        self.item_progress_old = {}
+        self.progress_sent = {}
+
+class _Job(object):
+
+    def __init__(self, cmd, args):
+        self.cmd = cmd
+        self.args = args
+        self.output = PackageKitBlockOutput()
+        self.transaction = _Transaction(self.output)
+        self.exit_code = None
+        self.started = False
+        self.cancelled = False
+        self.done = False
+
+class _WorkerPool(object):
+    '''
+    Run read-only commands on worker threads and write their output
+    blocks in the order the commands were received. A command calling
+    error() with exit=True sets exit_code, the blocks of the commands
+    after it are dropped and stopped() is called so the dispatcher exits
+    once the running commands are done. A cancelled command is ended
+    straight away, its worker keeps running but its blocks are dropped.
+    '''
+
+    def __init__(self, backend, size, stopped):
+        self.backend = backend
+        self.stopped = stopped
+        self.exit_code = None
+        self.jobs = queue.Queue()
+        self.pending = []
+        self.lock = threading.Condition(threading.Lock())
+        for i in range(size):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, cmd, args):
+        job = _Job(cmd, args)
+        with self.lock:
+            self.pending.append(job)
+        self.jobs.put(job)
+
+    def wait(self):
+        '''
+        Block until every submitted command has been written out
+        '''
+        with self.lock:
+            while self.pending:
+                self.lock.wait(1.0)
+
+    def cancel(self):
+        '''
+        Cancel the oldest command not written out yet if it allows it,
+        return False if there is none
+        '''
+        with self.lock:
+            if not self.pending:
+                return False
+            job = self.pending[0]
+            if job.started and not job.transaction.can_cancel:
+                return True
+            job.cancelled = True
+            self.pending.pop(0)
+            if self.exit_code is None:
+                self.backend._write_cancelled()
+            failed = self._write_done()
+            self.lock.notify_all()
+        if failed:
+            self.stopped()
+        return True
+
+    def drop_queued(self):
+        '''
+        Forget the commands no worker has started yet
+        '''
+        with self.lock:
+            for job in self.pending:
+                if not job.started:
+                    job.cancelled = True
+            # the workers take the commands in order, the ones left are
+            # all still running
+            self.pending = [job for job in self.pending if not job.cancelled]
+            self.lock.notify_all()
+
+    def _write_done(self):
+        '''
+        Write out the finished commands in order, return True if one of
+        them failed, called with the lock held
+        '''
+        failed = False
+        while self.pending and self.pending[0].done:
+            done = self.pending.pop(0)
+            if self.exit_code is not None:
+                continue
+            self.backend._write_job(done)
+            if done.exit_code is not None:
+                self.exit_code = done.exit_code
+                failed = True
+        return failed
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            with self.lock:
+                if job.cancelled:
+                    continue
+                job.started = True
+            self.backend._run_job(job)
+            with self.lock:
+                job.done = True
+                failed = self._write_done()
+                self.lock.notify_all()
+            # outside the lock, the dispatcher may be waiting on the pool
+            if failed:
+                self.stopped()
+
+class _CommandReader(threading.Thread):
+    '''
+    Read commands from stdin into a bounded queue while the backend is
+    busy, so the daemon can send the next one before 'finished'.
+    'exit' and 'cancel' are handled as soon as they are read, by calling
+    control(line): 'exit' drops the queued commands and the backend exits
+    once the running ones are done. End of file lets the queued commands
+    run first.
+    '''
+
+    def __init__(self, size, control):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue.Queue(size)
+        self.control = control
+        self.exiting = False
+
+    def run(self):
+        while True:
+            try:
+                line = sys.stdin.readline()
+            except EnvironmentError as e:
+                self.queue.put(e)
+                return
+            line = line.strip('\n')
+            if line == 'cancel':
+                self.control(line)
+                continue
+            if line == 'exit':
+                self.exiting = True
+                self._drop_queued()
+                self.control(line)
+            if not line or line == 'exit':
+                self.queue.put(None)
+                return
+            self.queue.put(line)
+
+    def _drop_queued(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def stop(self):
+        '''
+        Wake up the dispatcher as if stdin was closed
+        '''
+        self.queue.put(None)
+
+    def get(self):
+        # wake up regularly so signals still reach the main thread
+        while True:
+            try:
+                return self.queue.get(True, 1.0)
+            except queue.Empty:
+                continue
 
 
 def format_string(text, encoding='utf-8'):
@@ -764,6 +1241,41 @@ def _bool_to_string(value):
         return "true"
     return "false"
 
+# line templates of the signals whose fields are never lists or booleans,
+# the others are formatted field by field
+_LINE_TEMPLATES = {
+    'percentage': 'percentage\t%d\n',
+    'speed': 'speed\t%d\n',
+    'remaining-time': 'remaining-time\t%d\n',
+    'item-progress': 'item-progress\t%s\t%s\t%d\n',
+    'error': 'error\t%s\t%s\n',
+    'message': 'message\t%s\t%s\n',
+    'package': 'package\t%s\t%s\t%s\n',
+    'status': 'status\t%s\n',
+    'data': 'data\t%s\n',
+    'details': 'details\t%s\t%s\t%s\t%s\t%s\t%s\t%d\n',
+    'category': 'category\t%s\t%s\t%s\t%s\t%s\n',
+    'finished': 'finished\n',
+}
+
+# python 3 text records are encoded by the output, once per write
+_TEXT_RECORDS = sys.version_info[0] >= 3
+
+def _encode_line(name, fields):
+    '''
+    Return the tab separated line of a signal
+    '''
+    template = _LINE_TEMPLATES.get(name)
+    if template is not None:
+        record = template % fields
+    elif fields:
+        record = name + '\t' + '\t'.join(map(framing.field_to_string, fields)) + '\n'
+    else:
+        record = name + '\n'
+    if _TEXT_RECORDS:
+        return record
+    return _to_utf8(record)
+
 def get_package_id(name, version, arch, data):
     """Returns a package id."""
     return ";".join((name, version, arch, data))
@@ -775,21 +1287,101 @@ def split_package_id(id):
     """
     return id.split(";", 4)
 
+def _format_exception(typ, value, tb):
+    etb = traceback.extract_tb(tb)
+    errmsg = 'Error Type: %s;' % str(typ)
+    errmsg += 'Error Value: %s;' % str(value)
+    for tub in etb:
+        f, l, m, c = tub # file, lineno, function, codeline
+        errmsg += '  File : %s, line %s, in %s;' % (f, str(l), m)
+        errmsg += '    %s;' % c
+    return errmsg
+
 def exceptionHandler(typ, value, tb, base):
     # Restore original exception handler
     sys.excepthook = sys.__excepthook__
     # Call backend custom Traceback handler
     if not base.customTracebackHandler(typ):
-        etb = traceback.extract_tb(tb)
-        errmsg = 'Error Type: %s;' % str(typ)
-        errmsg += 'Error Value: %s;' % str(value)
-        for tub in etb:
-            f, l, m, c = tub # file, lineno, function, codeline
-            errmsg += '  File : %s, line %s, in %s;' % (f, str(l), m)
-            errmsg += '    %s;' % c
         # send the traceback to PackageKit
-        base.error(ERROR_INTERNAL_ERROR, errmsg, exit=True)
+        base.error(ERROR_INTERNAL_ERROR, _format_exception(typ, value, tb), exit=True)
 
 def installExceptionHandler(base):
     sys.excepthook = lambda typ, value, tb: exceptionHandler(typ, value, tb, base)
 
+def _split_list(text):
+    return text.split(';')
+
+def _split_package_ids(text):
+    return text.split(PACKAGE_IDS_DELIM)
+
+def _split_values(text):
+    return _to_unicode(text).split(PACKAGE_IDS_DELIM)
+
+def _split_files(text):
+    return text.split(FILENAME_DELIM)
+
+def _identity(text):
+    return text
+
+# enum values are lower case words joined by '-', e.g. 'gpg' or '~installed'
+_ENUM_VALUE = re.compile(r'^~?[a-z0-9]+(-[a-z0-9]+)*$')
+
+def _parse_enum(text):
+    if not _ENUM_VALUE.match(text):
+        raise ValueError("'%s' is not an enum value" % text)
+    return text
+
+def _parse_args(method, parsers, args):
+    '''
+    Return the parsed arguments of a command, raise ValueError if there
+    are too many or too few of them or one of them is malformed
+    '''
+    if len(args) != len(parsers):
+        raise ValueError('%s takes %d arguments, %d given' %
+                         (method, len(parsers), len(args)))
+    return [parse(arg) for parse, arg in zip(parsers, args)]
+
+_ARG_PARSERS = {
+    ARG_STRING: _identity,
+    ARG_ENUM: _parse_enum,
+    ARG_BOOL: _text_to_bool,
+    ARG_FILTERS: PackagekitFilterFlags.parse,
+    ARG_FLAGS: _split_list,
+    ARG_PACKAGE_IDS: _split_package_ids,
+    ARG_VALUES: _split_values,
+    ARG_FILES: _split_files,
+}
+
+for _name, _method, _schema in (
+        ('depends-on', 'depends_on', (ARG_FILTERS, ARG_PACKAGE_IDS, ARG_BOOL)),
+        ('download-packages', 'download_packages', (ARG_STRING, ARG_PACKAGE_IDS)),
+        ('get-categories', 'get_categories', ()),
+        ('get-details', 'get_details', (ARG_PACKAGE_IDS,)),
+        ('get-details-local', 'get_details_local', (ARG_PACKAGE_IDS,)),
+        ('get-distro-upgrades', 'get_distro_upgrades', ()),
+        ('get-files', 'get_files', (ARG_PACKAGE_IDS,)),
+        ('get-packages', 'get_packages', (ARG_FILTERS,)),
+        ('get-repo-list', 'get_repo_list', (ARG_FILTERS,)),
+        ('get-update-detail', 'get_update_detail', (ARG_PACKAGE_IDS,)),
+        ('get-updates', 'get_updates', (ARG_FILTERS,)),
+        ('install-files', 'install_files', (ARG_FLAGS, ARG_FILES)),
+        ('install-packages', 'install_packages', (ARG_FLAGS, ARG_PACKAGE_IDS)),
+        ('install-signature', 'install_signature', (ARG_ENUM, ARG_STRING, ARG_STRING)),
+        ('refresh-cache', 'refresh_cache', (ARG_BOOL,)),
+        ('remove-packages', 'remove_packages', (ARG_FLAGS, ARG_PACKAGE_IDS, ARG_BOOL, ARG_BOOL)),
+        ('repair-system', 'repair_system', (ARG_STRING,)),
+        ('repo-enable', 'repo_enable', (ARG_STRING, ARG_BOOL)),
+        ('repo-set-data', 'repo_set_data', (ARG_STRING, ARG_STRING, ARG_STRING)),
+        ('required-by', 'required_by', (ARG_FILTERS, ARG_PACKAGE_IDS, ARG_BOOL)),
+        ('resolve', 'resolve', (ARG_FILTERS, ARG_PACKAGE_IDS)),
+        ('search-details', 'search_details', (ARG_FILTERS, ARG_VALUES)),
+        ('search-file', 'search_file', (ARG_FILTERS, ARG_PACKAGE_IDS)),
+        ('search-group', 'search_group', (ARG_FILTERS, ARG_PACKAGE_IDS)),
+        ('search-name', 'search_name', (ARG_FILTERS, ARG_VALUES)),
+        ('set-locale', 'set_locale', (ARG_STRING,)),
+        ('signature-install', 'repo_signature_install', (ARG_STRING,)),
+        ('update-packages', 'update_packages', (ARG_FLAGS, ARG_PACKAGE_IDS)),
+        ('upgrade-system', 'upgrade_system', (ARG_STRING,)),
+        ('what-provides', 'what_provides', (ARG_FILTERS, ARG_ENUM, ARG_VALUES)),
+        ):
+    PackageKitBaseBackend.register_command(_name, _method, *_schema)
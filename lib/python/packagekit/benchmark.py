@@ -0,0 +1,280 @@
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# This file contains benchmarks for the python backends, run it with
+#
+#   python -m packagekit.benchmark startup --budget 0.5 \
+#       /usr/share/PackageKit/helpers/portage/portageBackend.py \
+#       get-categories "get-repo-list none"
+#
+# Sessions recorded with PK_BACKEND_RECORD=/tmp/session.log are replayed
+# with
+#
+#   python -m packagekit.benchmark replay /tmp/session.log \
+#       data/tests/pk-spawn-standin.py
+#
+# The records/s figure of a get-packages session replayed against the
+# stand-in backend with PK_STANDIN_PACKAGES=100000 is the reference for
+# the cost of sending signals.
+#
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from . import framing
+
+def _helper_env():
+    '''
+    Return the environment the daemon gives to spawned helpers
+    '''
+    env = dict(os.environ)
+    env.setdefault('LANG', 'C')
+    env.setdefault('NETWORK', 'TRUE')
+    env.setdefault('UID', str(os.getuid()))
+    env.setdefault('BACKGROUND', 'FALSE')
+    env.setdefault('INTERACTIVE', 'FALSE')
+    env.setdefault('CACHE_AGE', '0')
+    return env
+
+def measure_startup(helper, args, runs=5):
+    '''
+    Return the median time from exec to the first line sent by the helper
+    @param helper: path of the backend script
+    @param args: the command and its arguments
+    @param runs: number of times the helper is started
+    '''
+    timings = []
+    env = _helper_env()
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            started = time.time()
+            proc = subprocess.Popen([sys.executable, helper] + list(args),
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=devnull, env=env)
+            proc.stdout.readline()
+            timings.append(time.time() - started)
+            proc.communicate(b'exit\n')
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def load_session(path):
+    '''
+    Return the commands of a recorded session and the records sent for
+    each of them
+    @param path: a log written with PK_BACKEND_RECORD
+    '''
+    commands = []
+    records = []
+    with open(path) as log:
+        for line in log:
+            direction, data = line.split('\t', 1)
+            if direction == '>':
+                commands.append(data.rstrip('\n').split('\t'))
+            elif direction == '<':
+                records.append(data)
+    # the output of every command ends with finished, the dispatcher
+    # writes them in the order the commands were received
+    blocks = []
+    block = []
+    for record in records:
+        block.append(record)
+        if record == 'finished\n':
+            blocks.append(block)
+            block = []
+    if block:
+        blocks.append(block)
+    return commands, blocks
+
+class _Helper(object):
+    '''
+    A backend helper started like the daemon does
+    '''
+
+    def __init__(self, helper, framed=False):
+        env = _helper_env()
+        if framed:
+            env[framing.FRAMING_ENV] = framing.FRAMING_LENGTH
+        self.devnull = open(os.devnull, 'w')
+        self.proc = subprocess.Popen([sys.executable, helper],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=self.devnull, env=env)
+        self.records = None
+        if framed and self.proc.stdout.readline() == framing.HELLO:
+            self.records = framing.read_records(self.proc.stdout)
+
+    def _read(self):
+        if self.records is None:
+            return self.proc.stdout.readline().decode('utf-8', 'replace')
+        for fields in self.records:
+            return framing.format_record(fields)
+        return ''
+
+    def run(self, args):
+        '''
+        Send a command and return the records it sent, the helper has
+        exited if the last one is not finished
+        '''
+        self.proc.stdin.write(('\t'.join(args) + '\n').encode('utf-8'))
+        self.proc.stdin.flush()
+        records = []
+        while True:
+            record = self._read()
+            if not record:
+                break
+            records.append(record)
+            if record == 'finished\n':
+                break
+        return records
+
+    def close(self):
+        try:
+            self.proc.communicate(b'exit\n')
+        except (IOError, OSError):
+            pass
+        self.devnull.close()
+
+def replay_session(helper, commands, framed=False):
+    '''
+    Run the commands one after the other and return, for each of them,
+    the time it took and the records it sent
+    @param helper: path of the backend script
+    @param commands: list of commands with their arguments
+    @param framed: ask the helper for length prefixed records
+    '''
+    results = []
+    proc = _Helper(helper, framed)
+    for args in commands:
+        started = time.time()
+        records = proc.run(args)
+        results.append((args[0], time.time() - started, records))
+        if not records or records[-1] != 'finished\n':
+            # a fatal error made the helper exit
+            proc.close()
+            proc = _Helper(helper, framed)
+    proc.close()
+    return results
+
+def percentile(values, percent):
+    '''
+    Return the value below which percent of the sorted values fall
+    '''
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+# sent depending on timing, two runs never send the same ones
+_PROGRESS_RECORDS = ('percentage\t', 'item-progress\t', 'speed\t',
+                     'remaining-time\t')
+
+def _comparable(records):
+    return [record for record in records
+            if not record.startswith(_PROGRESS_RECORDS)]
+
+def replay(options):
+    commands, blocks = load_session(options.session)
+    commands = commands * options.repeat
+    started = time.time()
+    results = replay_session(options.helper, commands, options.framing)
+    elapsed = time.time() - started
+
+    nrecords = sum(len(records) for cmd, latency, records in results)
+    nbytes = sum(len(record.encode('utf-8'))
+                 for cmd, latency, records in results for record in records)
+    print('%d commands in %.3fs: %.1f commands/s, %.1f records/s, '
+          '%.1f bytes/s' % (len(results), elapsed, len(results) / elapsed,
+                            nrecords / elapsed, nbytes / elapsed))
+
+    latencies = {}
+    for cmd, latency, records in results:
+        latencies.setdefault(cmd, []).append(latency)
+    for cmd in sorted(latencies):
+        values = sorted(latencies[cmd])
+        print('%-24s %6d runs  p50 %9.3fms  p99 %9.3fms' %
+              (cmd, len(values), percentile(values, 50) * 1000,
+               percentile(values, 99) * 1000))
+
+    if not options.check:
+        return 0
+    mismatches = 0
+    for i, (cmd, latency, records) in enumerate(results[:len(blocks)]):
+        if _comparable(records) != _comparable(blocks[i]):
+            mismatches += 1
+            print('output of command %d (%s) differs from the recording' %
+                  (i + 1, cmd))
+    return 1 if mismatches else 0
+
+def _parse_budgets(values):
+    budgets = {}
+    for value in values:
+        cmd, budget = value.split('=', 1)
+        budgets[cmd] = float(budget)
+    return budgets
+
+def startup(options):
+    budgets = _parse_budgets(options.budget_for)
+    failed = False
+    for spec in options.commands:
+        args = spec.split()
+        budget = budgets.get(args[0], options.budget)
+        elapsed = measure_startup(options.helper, args, options.runs)
+        over = budget is not None and elapsed > budget
+        failed = failed or over
+        print('%-24s %8.3fs%s' % (spec, elapsed,
+              ' over budget of %.3fs' % budget if over else ''))
+    return 1 if failed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='packagekit.benchmark')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    sub = subparsers.add_parser('startup',
+                                help='time from exec to the first signal')
+    sub.add_argument('--runs', type=int, default=5)
+    sub.add_argument('--budget', type=float, default=None,
+                     help='seconds allowed for every command')
+    sub.add_argument('--budget-for', action='append', default=[],
+                     metavar='COMMAND=SECONDS',
+                     help='seconds allowed for one command')
+    sub.add_argument('helper', help='the backend script')
+    sub.add_argument('commands', nargs='+',
+                     help='command and arguments, e.g. "search-name none vim"')
+    sub.set_defaults(run=startup)
+
+    sub = subparsers.add_parser('replay',
+                                help='replay a recorded session')
+    sub.add_argument('--repeat', type=int, default=1,
+                     help='replay the session this many times')
+    sub.add_argument('--check', action='store_true',
+                     help='compare the records with the recording')
+    sub.add_argument('--framing', action='store_true',
+                     help='ask the helper for length prefixed records')
+    sub.add_argument('session', help='log written with PK_BACKEND_RECORD')
+    sub.add_argument('helper', help='the backend script')
+    sub.set_defaults(run=replay)
+
+    options = parser.parse_args(argv)
+    if not hasattr(options, 'run'):
+        parser.error('no benchmark given')
+    return options.run(options)
+
+if __name__ == '__main__':
+    sys.exit(main())
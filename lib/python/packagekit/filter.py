@@ -22,104 +22,473 @@
 from .enums import *
 from .package import PackagekitPackage
 import collections
+import threading
+
+# one bit per filter, in the order of the generated enum
+_FILTER_BITS = dict((flt, 1 << i) for i, flt in enumerate(PackageKitEnum.filter))
+
+def _mask(*filters):
+    mask = 0
+    for flt in filters:
+        mask |= _FILTER_BITS[flt]
+    return mask
+
+class PackagekitFilterFlags(object):
+    '''
+    A set of filters parsed once into a bitmask.
+
+    Usage:
+
+    filters = PackagekitFilterFlags.parse('installed;~devel')
+    if FILTER_INSTALLED in filters:
+        ...
+    if filters.mask & PackagekitFilterFlags.BASE:
+        ...
+
+    Membership tests take constant time. Iterating gives the filter names
+    in the order they were given, so code written for the ';' split list
+    keeps working. Instances are immutable and shared between commands
+    using the same filters.
+    '''
+
+    # filters PackagekitFilter checks with the _pkg_is_* hooks
+    BASE = _mask(FILTER_GUI, FILTER_NOT_GUI, FILTER_DEVELOPMENT,
+                 FILTER_NOT_DEVELOPMENT, FILTER_FREE, FILTER_NOT_FREE,
+                 FILTER_ARCH, FILTER_NOT_ARCH)
+    INSTALLED = _mask(FILTER_INSTALLED, FILTER_NOT_INSTALLED)
+    FREE = _mask(FILTER_FREE, FILTER_NOT_FREE)
+    NEWEST = _mask(FILTER_NEWEST, FILTER_NOT_NEWEST)
+
+    _cache = {}
+
+    def __init__(self, names):
+        '''
+        @param names: filter names, unknown ones are kept but never match
+        '''
+        self.names = tuple(name for name in names if name)
+        self.mask = 0
+        for name in self.names:
+            self.mask |= _FILTER_BITS.get(name, 0)
+        # the combinations the backends test in their per package loops
+        self.installed = FILTER_INSTALLED in self
+        self.not_installed = FILTER_NOT_INSTALLED in self
+        self.newest = FILTER_NEWEST in self
+        self.free = FILTER_FREE in self
+        self.not_free = FILTER_NOT_FREE in self
+
+    @classmethod
+    def parse(cls, filters):
+        '''
+        Return the flags of filters given as a ';' separated string, a list
+        of names, or flags
+        '''
+        if isinstance(filters, cls):
+            return filters
+        if not isinstance(filters, (str, type(u''))):
+            filters = ';'.join(filters)
+        try:
+            return cls._cache[filters]
+        except KeyError:
+            pass
+        flags = cls(filters.split(';'))
+        if len(cls._cache) >= 256:
+            cls._cache.clear()
+        cls._cache[filters] = flags
+        return flags
+
+    def __contains__(self, name):
+        return bool(self.mask & _FILTER_BITS.get(name, 0))
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __eq__(self, other):
+        if isinstance(other, PackagekitFilterFlags):
+            return self.names == other.names
+        return list(self.names) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.names)
+
+    def __str__(self):
+        return ';'.join(self.names)
+
+    def __repr__(self):
+        return 'PackagekitFilterFlags(%r)' % (list(self.names),)
+
+class PackagekitPredicateCache(object):
+    '''
+    Results of the _pkg_is_* hooks of PackagekitFilter, kept across
+    commands for the most recently used packages.
+
+    Usage:
+
+    self.filter_cache = PackagekitPredicateCache(50000)
+    ...
+    fltr = MyFilter(filters, cache=self.filter_cache)
+    ...
+    def reload_state(self, stale):
+        self.filter_cache.clear()
+
+    The cache is keyed with _pkg_get_key() and can be shared by the
+    filters of concurrent commands. Call invalidate() or clear() when the
+    package metadata changes.
+    '''
+
+    def __init__(self, size=65536):
+        '''
+        @param size: number of packages whose results are kept
+        '''
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, hook):
+        '''
+        Return the cached result of a hook for a package, or None
+        '''
+        with self._lock:
+            results = self._entries.pop(key, None)
+            if results is None:
+                self.misses += 1
+                return None
+            # reinserting moves the package to the most recently used end
+            self._entries[key] = results
+            value = results.get(hook)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, hook, value):
+        '''
+        Remember the result of a hook for a package
+        '''
+        with self._lock:
+            results = self._entries.get(key)
+            if results is None:
+                results = self._entries[key] = {}
+                if len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            results[hook] = value
+
+    def invalidate(self, key):
+        '''
+        Forget the results of one package
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
 
-class PackagekitFilter(object, PackagekitPackage):
+    def clear(self):
+        '''
+        Forget all the results
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
 
-    def __init__(self, fltlist="none"):
-        ''' save state '''
-        self.fltlist = fltlist
+class PackagekitFilter(PackagekitPackage, object):
+
+    def __init__(self, fltlist="none", stream=False, cache=None):
+        '''
+        save state
+        @param cache: a PackagekitPredicateCache for the _pkg_is_* hooks
+        @param stream: return the packages that can be emitted straight away
+        from add_installed(), add_available() and add_custom() instead of
+        keeping them for get_package_list(), see close(). Ignored if
+        post_process() is overridden, see can_stream().
+        '''
+        self.fltlist = PackagekitFilterFlags.parse(fltlist)
         self.package_list = [] #we can't do emitting as found if we are post-processing
         self.installed_unique = {}
+        self.streaming = stream and self.can_stream()
+        self.predicate_cache = cache
+        self._plan = None
+        self._installed_newest = {}
+        # {name: [(pkg, state)]} of the packages a streaming filter holds
+        # until their name is closed
+        self._held = collections.OrderedDict()
+
+    def can_stream(self):
+        '''
+        Return if packages can be emitted as they are added, which needs
+        no post-processing of the whole list
+        '''
+        return type(self).post_process == PackagekitFilter.post_process
 
     def add_installed(self, pkgs):
         ''' add a list of packages that are already installed '''
+        if self.streaming:
+            return self._stream_packages(pkgs, INFO_INSTALLED)
         for pkg in pkgs:
             self.package_list.append((pkg, INFO_INSTALLED))
+        return []
 
     def add_available(self, pkgs):
         ''' add a list of packages that are available '''
+        if self.streaming:
+            return self._stream_packages(pkgs, INFO_AVAILABLE)
         for pkg in pkgs:
             self.package_list.append((pkg, INFO_AVAILABLE))
+        return []
 
     def add_custom(self, pkg, info):
         ''' add a custom packages indervidually '''
+        if self.streaming:
+            return self._stream_packages((pkg,), info)
         self.package_list.append((pkg, info))
+        return []
+
+    def close(self, name):
+        '''
+        Tell a streaming filter all the packages of a name were added,
+        return the ones it held back that pass the filters.
+
+        The available packages of a name, and all of them with the newest
+        filters, are held until the name is closed: an installed version
+        added later may still make them downgrades, or a later version
+        the newest one. Names that are never closed are released by
+        get_package_list(). The other packages are returned as they are
+        added, in any order.
+        '''
+        held = self._held.pop(name, None)
+        if not held:
+            return []
+        return self._release(held)
+
+    def _stream_packages(self, pkgs, state):
+        '''
+        Return the packages that pass the filters and need no comparison
+        with the other versions of their name, hold the others
+        '''
+        if self._plan is None:
+            self._plan = (self._compile_base(), self._compile_installed())
+        check_base, check_installed = self._plan
+        installed_newest = self._installed_newest
+        get_name = self._pkg_get_name
+        hold_all = self.fltlist.mask & PackagekitFilterFlags.NEWEST
+        ready = []
+        for pkg in pkgs:
+            if check_base is not None and not check_base(pkg):
+                continue
+            if state is INFO_INSTALLED:
+                self._index_installed(installed_newest, pkg)
+            if hold_all or state is INFO_AVAILABLE:
+                self._held.setdefault(get_name(pkg), []).append((pkg, state))
+                continue
+            if check_installed is not None and not check_installed(pkg):
+                continue
+            ready.append((pkg, state))
+        return ready
+
+    def _release(self, package_list):
+        '''
+        Return the held packages that pass the filters, now the installed
+        versions of their names are known
+        '''
+        check_base, check_installed = self._plan
+        installed_newest = self._installed_newest
+        get_name = self._pkg_get_name
+        ready = []
+        for pkg, state in package_list:
+            if state is INFO_AVAILABLE and installed_newest and \
+               self._is_downgrade(pkg, installed_newest.get(get_name(pkg))):
+                continue
+            if check_installed is not None and not check_installed(pkg):
+                continue
+            ready.append((pkg, state))
+        if self.fltlist.mask & PackagekitFilterFlags.NEWEST:
+            ready = self._filter_newest(ready, self.fltlist.newest)
+        return ready
+
+    # the hooks checked for each pair of filters, cheapest first, so the
+    # expensive ones only run on packages the others kept; subclasses
+    # reorder this when their costs differ
+    predicates = (
+        (FILTER_ARCH, FILTER_NOT_ARCH, '_pkg_is_arch'),
+        (FILTER_DEVELOPMENT, FILTER_NOT_DEVELOPMENT, '_pkg_is_devel'),
+        (FILTER_GUI, FILTER_NOT_GUI, '_pkg_is_gui'),
+        (FILTER_FREE, FILTER_NOT_FREE, '_pkg_is_free'),
+    )
+
+    def _compile_base(self):
+        '''
+        Return the predicate of the filters checked with the _pkg_is_*
+        hooks, or None if there are none
+        '''
+        checks = []
+        for flt, not_flt, hook in self.predicates:
+            if flt in self.fltlist:
+                checks.append((self._get_hook(hook), True))
+            elif not_flt in self.fltlist:
+                checks.append((self._get_hook(hook), False))
+        if not checks:
+            return None
+        if len(checks) == 1:
+            (hook, wanted), = checks
+            return lambda pkg: bool(hook(pkg)) is wanted
+
+        def _check(pkg):
+            for hook, wanted in checks:
+                if bool(hook(pkg)) is not wanted:
+                    return False
+            return True
+        return _check
+
+    def _get_hook(self, name):
+        '''
+        Return a _pkg_is_* hook, going through the predicate cache if the
+        filter has one
+        '''
+        hook = getattr(self, name)
+        cache = self.predicate_cache
+        if cache is None:
+            return hook
+        get_key = self._pkg_get_key
+
+        def _cached(pkg):
+            key = get_key(pkg)
+            value = cache.get(key, name)
+            if value is None:
+                value = bool(hook(pkg))
+                cache.set(key, name, value)
+            return value
+        return _cached
+
+    def _compile_installed(self):
+        '''
+        Return the predicate of the installed filters, or None
+        '''
+        if FILTER_INSTALLED in self.fltlist:
+            wanted = True
+        elif FILTER_NOT_INSTALLED in self.fltlist:
+            wanted = False
+        else:
+            return None
+        hook = self._pkg_is_installed
+        return lambda pkg: bool(hook(pkg)) is wanted
 
     def _filter_base(self, pkg):
         ''' do extra filtering (gui, devel etc) '''
-        for flt in self.fltlist:
-            if flt in (FILTER_GUI, FILTER_NOT_GUI):
-                if not self._do_gui_filtering(flt, pkg):
-                    return False
-            elif flt in (FILTER_DEVELOPMENT, FILTER_NOT_DEVELOPMENT):
-                if not self._do_devel_filtering(flt, pkg):
-                    return False
-            elif flt in (FILTER_FREE, FILTER_NOT_FREE):
-                if not self._do_free_filtering(flt, pkg):
-                    return False
-            elif flt in (FILTER_ARCH, FILTER_NOT_ARCH):
-                if not self._do_arch_filtering(flt, pkg):
-                    return False
-        return True
+        check = self._compile_base()
+        return check is None or check(pkg)
 
     def _filter_installed(self, pkg):
         ''' do extra filtering (gui, devel etc) '''
-        for flt in self.fltlist:
-            if flt in (FILTER_INSTALLED, FILTER_NOT_INSTALLED):
-                if not self._do_installed_filtering(flt, pkg):
-                    return False
-        return True
+        check = self._compile_installed()
+        return check is None or check(pkg)
 
     def get_package_list(self):
         '''
-        do filtering we couldn't do when generating the list
+        do filtering we couldn't do when generating the list, a streaming
+        filter returns the packages of the names it still holds
         '''
-
-        # filter common things here like architecture
+        if self.streaming:
+            held = [entry for entries in self._held.values()
+                    for entry in entries]
+            self._held.clear()
+            if not held:
+                return []
+            return self._release(held)
+
+        # filter common things here like architecture, and keep the newest
+        # installed version of every name for the downgrade check
         # NOTE: we can't do installed and ~installed here as we need
         # this data for the newest and downgrade checks below
-        package_list = self.package_list
-        self.package_list = []
-        for pkg, state in package_list:
-            if self._filter_base(pkg):
-                self.package_list.append((pkg, state))
-
-        # prepare lookup table of installed packages
-        installed_dict = collections.defaultdict(list)
+        check_base = self._compile_base()
+        check_installed = self._compile_installed()
+        get_name = self._pkg_get_name
+        installed_newest = {}
+        package_list = []
         for pkg, state in self.package_list:
+            if check_base is not None and not check_base(pkg):
+                continue
+            package_list.append((pkg, state))
             if state is INFO_INSTALLED:
-                installed_dict[self._pkg_get_name(pkg)].append(pkg)
+                self._index_installed(installed_newest, pkg)
 
-        # check there are not available versions in the package list
-        # that are older than the installed version
-        package_list = self.package_list
+        # drop available versions that are the same as or older than the
+        # installed version, and filter installed state last
         self.package_list = []
         for pkg, state in package_list:
+            if state is INFO_AVAILABLE and installed_newest and \
+               self._is_downgrade(pkg, installed_newest.get(get_name(pkg))):
+                continue
+            if check_installed is not None and not check_installed(pkg):
+                continue
+            self.package_list.append((pkg, state))
 
-            add = True
-            if state is INFO_AVAILABLE:
-                for pkg_tmp in installed_dict[self._pkg_get_name(pkg)]:
-                    rc = self._pkg_compare(pkg, pkg_tmp)
-
-                    # don't add if the same as the installed package
-                    # or a downgrade to the existing installed package
-                    if rc == 0 or rc == -1:
-                        add = False
-                        break
-
-            if add:
-                self.package_list.append((pkg, state))
-
-        # filter installed state last
-        package_list = self.package_list
-        self.package_list = []
-        for pkg, state in package_list:
-            if self._filter_installed(pkg):
-                self.package_list.append((pkg, state))
+        if self.fltlist.mask & PackagekitFilterFlags.NEWEST:
+            self.package_list = self._filter_newest(self.package_list,
+                                                    self.fltlist.newest)
 
         # do the backend specific filtering
         return self.post_process()
 
+    def _index_installed(self, installed_newest, pkg):
+        '''
+        Keep the newest installed versions of each name
+        '''
+        self._keep_newest(
+            installed_newest.setdefault(self._pkg_get_name(pkg), []), pkg, pkg)
+
+    def _keep_newest(self, newest, pkg, value):
+        '''
+        Add (pkg, value) to newest, the list of the versions no other
+        version is newer than, unless one of them is the same as or newer
+        than pkg. Versions that can't be compared with each other, e.g.
+        in different slots, are all kept.
+        '''
+        kept = []
+        for entry in newest:
+            rc = self._pkg_compare(pkg, entry[0])
+            if rc == 0 or rc == -1:
+                return
+            if rc != 1:
+                kept.append(entry)
+        kept.append((pkg, value))
+        newest[:] = kept
+
+    def _is_downgrade(self, pkg, newest):
+        '''
+        Return if an available package is the same as or older than one
+        of the newest installed versions of its name, or one of the others
+        as they are all older
+        '''
+        if not newest:
+            return False
+        for installed, value in newest:
+            rc = self._pkg_compare(pkg, installed)
+            if rc == 0 or rc == -1:
+                return True
+        return False
+
+    def _filter_newest(self, package_list, newest=True):
+        '''
+        Keep only the newest installed and the newest available versions
+        of every name, or only the others if newest is False. Versions
+        that can't be compared are all newest.
+        '''
+        get_name = self._pkg_get_name
+        best = {}
+        for i, (pkg, state) in enumerate(package_list):
+            key = (get_name(pkg), state is INFO_INSTALLED)
+            self._keep_newest(best.setdefault(key, []), pkg, i)
+        keep = set(i for entries in best.values() for pkg, i in entries)
+        return [entry for i, entry in enumerate(package_list)
+                if (i in keep) is newest]
+
     def post_process(self):
         '''
         do filtering we couldn't do when generating the list
@@ -146,6 +515,13 @@ class PackagekitFilter(object, PackagekitPackage):
         '''
         return None
 
+    def _pkg_get_key(self, pkg):
+        '''
+        Returns the key of the package in the predicate cache, which must
+        be hashable and unique, e.g. the package id
+        '''
+        return pkg
+
     def _pkg_is_installed(self, pkg):
         '''
         Return if the package is installed.
@@ -0,0 +1,165 @@
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# This file contains the length prefixed framing of the records sent by
+# the helpers, used instead of tab separated lines when the daemon sets
+# PK_BACKEND_FRAMING=length in the helper environment. The helper confirms
+# by sending the line "framing<TAB>length" before its first frame, a helper
+# that does not know about framing keeps sending lines.
+#
+# Every frame is
+#
+#   uint32  length of the rest of the frame, big endian
+#   uint16  number of fields
+#   fields  a one byte type followed by the value:
+#           's'  uint32 length, UTF-8 text
+#           'i'  int64
+#           'b'  one byte, 0 or 1
+#           'l'  uint32 count, then count times uint32 length, UTF-8 text
+#           'n'  nothing, None
+#
+# The first field is the signal name, e.g. "package".
+#
+
+import numbers
+import struct
+
+FRAMING_ENV = 'PK_BACKEND_FRAMING'
+FRAMING_LENGTH = 'length'
+HELLO = b'framing\tlength\n'
+
+_UINT16 = struct.Struct('!H')
+_UINT32 = struct.Struct('!I')
+_INT64 = struct.Struct('!q')
+
+def _utf8(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, type(u'')):
+        value = u'%s' % (value,)
+    return value.encode('utf-8', 'replace')
+
+def _encode_field(value, parts):
+    if value is None:
+        parts.append(b'n')
+    elif isinstance(value, bool):
+        parts.append(b'b\x01' if value else b'b\x00')
+    elif isinstance(value, numbers.Integral):
+        parts.append(b'i' + _INT64.pack(value))
+    elif isinstance(value, (list, tuple)):
+        parts.append(b'l' + _UINT32.pack(len(value)))
+        for item in value:
+            item = _utf8(item)
+            parts.append(_UINT32.pack(len(item)))
+            parts.append(item)
+    else:
+        value = _utf8(value)
+        parts.append(b's' + _UINT32.pack(len(value)))
+        parts.append(value)
+
+def encode_record(name, fields):
+    '''
+    Return the frame of a signal
+    @param name: the signal name, e.g. "package"
+    @param fields: the values of the signal
+    '''
+    parts = [None, _UINT16.pack(len(fields) + 1)]
+    _encode_field(name, parts)
+    for value in fields:
+        _encode_field(value, parts)
+    size = sum(len(part) for part in parts[1:])
+    parts[0] = _UINT32.pack(size)
+    return b''.join(parts)
+
+def decode_record(payload):
+    '''
+    Return the fields of a frame, without its length prefix
+    '''
+    count, = _UINT16.unpack_from(payload, 0)
+    offset = _UINT16.size
+    fields = []
+    for i in range(count):
+        kind = payload[offset:offset + 1]
+        offset += 1
+        if kind == b'n':
+            fields.append(None)
+        elif kind == b'b':
+            fields.append(payload[offset:offset + 1] == b'\x01')
+            offset += 1
+        elif kind == b'i':
+            fields.append(_INT64.unpack_from(payload, offset)[0])
+            offset += _INT64.size
+        elif kind == b'l':
+            items, = _UINT32.unpack_from(payload, offset)
+            offset += _UINT32.size
+            value = []
+            for j in range(items):
+                size, = _UINT32.unpack_from(payload, offset)
+                offset += _UINT32.size
+                value.append(payload[offset:offset + size].decode('utf-8'))
+                offset += size
+            fields.append(value)
+        elif kind == b's':
+            size, = _UINT32.unpack_from(payload, offset)
+            offset += _UINT32.size
+            fields.append(payload[offset:offset + size].decode('utf-8'))
+            offset += size
+        else:
+            raise ValueError('unknown field type %r' % kind)
+    return fields
+
+def field_to_string(value):
+    '''
+    Return a field the way it is written in a tab separated record
+    '''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (list, tuple)):
+        return ';'.join(value)
+    return '%s' % (value,)
+
+def format_record(fields):
+    '''
+    Return the tab separated line of decoded frame fields
+    '''
+    return '\t'.join(map(field_to_string, fields)) + '\n'
+
+def read_records(stream):
+    '''
+    Yield the fields of every frame read from a binary stream
+    @param stream: the helper stdout, after the hello line
+    '''
+    while True:
+        header = stream.read(_UINT32.size)
+        if len(header) < _UINT32.size:
+            return
+        size, = _UINT32.unpack(header)
+        yield decode_record(stream.read(size))
+
+def split_records(data):
+    '''
+    Yield the fields of every frame in a bytes object
+    '''
+    if not data:
+        return
+    if data.startswith(HELLO):
+        data = data[len(HELLO):]
+    offset = 0
+    while offset < len(data):
+        size, = _UINT32.unpack_from(data, offset)
+        offset += _UINT32.size
+        yield decode_record(data[offset:offset + size])
+        offset += size
@@ -0,0 +1,329 @@
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# This file contains a persistent index of the packages known to a backend,
+# stored in a SQLite database, so queries do not have to walk the package
+# databases. Backends give the index a provider:
+#
+#   index_sources()           {source: stamp}, e.g. the tree and the
+#                             installed packages, with a string changing
+#                             every time the source changes
+#   index_scan(source)        {package: stamp} of the packages of a source,
+#                             the stamp changes when its metadata changes
+#   index_fetch(source, pkg)  (name, values), the name the package is
+#                             grouped under and the values of the keys
+#
+# Only the sources whose stamp changed are scanned and only the packages
+# whose stamp changed are fetched again. The packages of the source named
+# "installed" are the installed ones.
+#
+# The values of the text keys are also split into lower case words, kept
+# in an inverted index used by search() to find the packages that may
+# contain a string without reading all of them.
+#
+
+import os
+import re
+import sqlite3
+import threading
+
+INSTALLED = 'installed'
+
+# bumped when the tables change
+_VERSION = '2'
+
+# packages whose metadata is kept by metadata()
+_ROWS_CACHE_SIZE = 256
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+def words(text):
+    '''
+    Return the set of lower case words of a text, every word of a string
+    found in the text is inside one of them
+    '''
+    return set(_WORD.findall(text.lower()))
+
+class PackagekitIndex(object):
+    '''
+    Package index kept up to date with the stamps of its provider.
+
+    Usage:
+
+    index = PackagekitIndex('/var/cache/index.sqlite', ['SLOT', 'LICENSE'],
+                            ['LICENSE'])
+    index.sync(provider)
+    for name in index.names():
+        for pkg in index.packages(name, installed=False):
+            slot, license = index.metadata(pkg, ['SLOT', 'LICENSE'])
+    candidates = index.search(['gpl'])
+    '''
+
+    def __init__(self, path, keys, text_keys=()):
+        '''
+        @param path: the database file, ':memory:' for a private index
+        @param keys: the metadata keys stored for every package
+        @param text_keys: the keys whose words are indexed for search()
+        '''
+        self.path = path
+        self.keys = list(keys)
+        self.text_keys = [key for key in self.keys if key in text_keys]
+        self._positions = dict((key, i) for i, key in enumerate(self.keys))
+        self._text = [i for i, key in enumerate(self.keys)
+                      if key in text_keys]
+        # {pkg: values} of the last packages metadata() was asked for
+        self._rows = {}
+        self._select = 'SELECT %s FROM packages WHERE pkg = ? ' \
+            'ORDER BY source = ? DESC LIMIT 1' % \
+            ', '.join('k%d' % i for i in range(len(self.keys)))
+        self._lock = threading.Lock()
+        # {id: (name, pkg)} for search(), loaded on first use
+        self._names = None
+        try:
+            self._db = self._open()
+        except sqlite3.OperationalError:
+            # locked or read-only, the file is fine, leave it alone
+            raise
+        except sqlite3.DatabaseError:
+            if path == ':memory:':
+                raise
+            # a damaged index is only a cache, start over
+            os.remove(path)
+            self._db = self._open()
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.text_factory = type(u'')
+        signature = '%s %s / %s' % (_VERSION, ' '.join(self.keys),
+                                    ' '.join(self.text_keys))
+        try:
+            current = db.execute(
+                "SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        except sqlite3.OperationalError:
+            current = None
+        if current is None or current[0] != signature:
+            db.executescript('''
+                DROP TABLE IF EXISTS meta;
+                DROP TABLE IF EXISTS sources;
+                DROP TABLE IF EXISTS packages;
+                DROP TABLE IF EXISTS words;
+                DROP TABLE IF EXISTS postings;
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE sources (source TEXT PRIMARY KEY, stamp TEXT);
+                CREATE TABLE packages (
+                    id INTEGER PRIMARY KEY,
+                    pkg TEXT, name TEXT, source TEXT, stamp TEXT, %s,
+                    UNIQUE (source, pkg));
+                CREATE INDEX packages_name ON packages (name);
+                CREATE INDEX packages_pkg ON packages (pkg);
+                CREATE TABLE words (id INTEGER PRIMARY KEY, word TEXT UNIQUE);
+                CREATE TABLE postings (
+                    word INTEGER, package INTEGER,
+                    PRIMARY KEY (word, package)) WITHOUT ROWID;
+            ''' % ', '.join('k%d TEXT' % i for i in range(len(self.keys))))
+            db.execute("INSERT INTO meta VALUES ('signature', ?)",
+                       (signature,))
+            db.commit()
+        return db
+
+    def sync(self, provider, force=False):
+        '''
+        Update the sources whose stamp changed, return their names
+        @param provider: see the top of this file
+        @param force: scan every source, for changes the stamps of the
+        sources missed
+        '''
+        updated = []
+        with self._lock:
+            stamps = dict(self._db.execute('SELECT source, stamp FROM sources'))
+            sources = provider.index_sources()
+            for source in stamps:
+                if source not in sources:
+                    self._db.execute(
+                        'DELETE FROM postings WHERE package IN '
+                        '(SELECT id FROM packages WHERE source = ?)',
+                        (source,))
+                    self._db.execute('DELETE FROM packages WHERE source = ?',
+                                     (source,))
+                    self._db.execute('DELETE FROM sources WHERE source = ?',
+                                     (source,))
+                    updated.append(source)
+            for source in sorted(sources):
+                if not force and stamps.get(source) == sources[source]:
+                    continue
+                self._sync_source(provider, source)
+                self._db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)',
+                                 (source, sources[source]))
+                updated.append(source)
+            # the stamps and the packages are committed together, an
+            # interrupted sync starts over next time
+            self._db.commit()
+            if updated:
+                self._names = None
+                self._rows = {}
+        return sorted(updated)
+
+    def _sync_source(self, provider, source):
+        known = dict((pkg, (rowid, stamp)) for rowid, pkg, stamp in
+                     self._db.execute('SELECT id, pkg, stamp FROM packages '
+                                      'WHERE source = ?', (source,)))
+        current = provider.index_scan(source)
+
+        word_ids = dict((word, rowid) for rowid, word in
+                        self._db.execute('SELECT id, word FROM words'))
+
+        # packages gone or changed, their postings are found again from
+        # their words
+        removed = [known[pkg][0] for pkg in known
+                   if pkg not in current or current[pkg] != known[pkg][1]]
+        postings = []
+        if self._text:
+            select = 'SELECT %s FROM packages WHERE id = ?' % \
+                ', '.join('k%d' % i for i in self._text)
+            for rowid in removed:
+                values = self._db.execute(select, (rowid,)).fetchone()
+                postings.extend((word_ids[word], rowid)
+                                for word in words(' '.join(values)))
+        self._db.executemany(
+            'DELETE FROM postings WHERE word = ? AND package = ?', postings)
+        self._db.executemany('DELETE FROM packages WHERE id = ?',
+                             [(rowid,) for rowid in removed])
+
+        new_words = []
+        postings = []
+        insert = 'INSERT INTO packages VALUES (NULL, %s)' % \
+            ', '.join('?' * (len(self.keys) + 4))
+        for pkg, stamp in current.items():
+            if pkg in known and known[pkg][1] == stamp:
+                continue
+            name, values = provider.index_fetch(source, pkg)
+            rowid = self._db.execute(
+                insert, (pkg, name, source, stamp) + tuple(values)).lastrowid
+            for word in words(' '.join(values[i] for i in self._text)):
+                if word not in word_ids:
+                    word_ids[word] = len(word_ids) + 1
+                    new_words.append((word_ids[word], word))
+                postings.append((word_ids[word], rowid))
+
+        self._db.executemany('INSERT INTO words VALUES (?, ?)', new_words)
+        # in the order of the table, much faster
+        postings.sort()
+        self._db.executemany('INSERT INTO postings VALUES (?, ?)', postings)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def names(self, installed=None):
+        '''
+        Return the sorted names of the packages
+        @param installed: True for the installed packages only, False for
+        the packages of the other sources, None for both with the installed
+        ones first
+        '''
+        if installed is None:
+            names = self.names(True)
+            seen = set(names)
+            names.extend(name for name in self.names(False)
+                         if name not in seen)
+            return names
+        op = '=' if installed else '!='
+        return [row[0] for row in self._query(
+            'SELECT DISTINCT name FROM packages WHERE source %s ? '
+            'ORDER BY name' % op, (INSTALLED,))]
+
+    def packages(self, name, installed=None):
+        '''
+        Return the packages grouped under a name
+        @param installed: True for the installed ones, False for the ones
+        of the other sources that are not installed, None for all of them
+        '''
+        if installed is None:
+            rows = self._query(
+                'SELECT DISTINCT pkg FROM packages WHERE name = ?', (name,))
+        elif installed:
+            rows = self._query(
+                'SELECT pkg FROM packages WHERE name = ? AND source = ?',
+                (name, INSTALLED))
+        else:
+            rows = self._query(
+                'SELECT DISTINCT pkg FROM packages WHERE name = ? '
+                'AND source != ? AND pkg NOT IN (SELECT pkg FROM packages '
+                'WHERE name = ? AND source = ?)',
+                (name, INSTALLED, name, INSTALLED))
+        return [row[0] for row in rows]
+
+    def metadata(self, pkg, keys):
+        '''
+        Return the values of keys for a package, the installed one if
+        there are several, or None if the package is not in the index
+        '''
+        # queries ask for several keys of the packages of a name, one
+        # after the other
+        try:
+            values = self._rows[pkg]
+        except KeyError:
+            rows = self._query(self._select, (pkg, INSTALLED))
+            values = rows[0] if rows else None
+            if len(self._rows) >= _ROWS_CACHE_SIZE:
+                self._rows = {}
+            self._rows[pkg] = values
+        if values is None:
+            return None
+        return [values[self._positions[key]] for key in keys]
+
+    def search(self, strings):
+        '''
+        Return {name: set of packages} of the packages whose text keys
+        may contain all the strings, ignoring case, or None if the
+        strings have no word to look for. A package is returned if every
+        word of every string is inside one of its words, callers check
+        the values of the returned packages.
+        '''
+        pieces = set()
+        for string in strings:
+            # python 2 gives byte strings, sqlite only takes text
+            if isinstance(string, bytes):
+                string = string.decode('utf-8', 'replace')
+            pieces.update(words(string))
+        if not pieces:
+            return None
+
+        found = None
+        # longest words first, they match fewer packages
+        for piece in sorted(pieces, key=len, reverse=True):
+            rows = self._query(
+                'SELECT DISTINCT package FROM postings WHERE word IN '
+                '(SELECT id FROM words WHERE instr(word, ?) > 0)', (piece,))
+            rows = set(row[0] for row in rows)
+            found = rows if found is None else found.intersection(rows)
+            if not found:
+                break
+
+        if self._names is None:
+            self._names = dict((row[0], row[1:]) for row in self._query(
+                'SELECT id, name, pkg FROM packages'))
+        candidates = {}
+        for rowid in found:
+            name, pkg = self._names[rowid]
+            candidates.setdefault(name, set()).add(pkg)
+        return candidates
+
+    def has_keys(self, keys):
+        '''
+        Return True if all the keys are stored in the index
+        '''
+        return all(key in self._positions for key in keys)
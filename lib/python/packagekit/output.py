@@ -0,0 +1,193 @@
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# This file contains the output channels used by PackageKitBaseBackend
+# to send signals to the daemon
+#
+
+import sys
+import threading
+import time
+
+from . import framing
+
+def _stream(record):
+    # framed records are bytes, on python 3 they bypass the text layer
+    if isinstance(record, str):
+        return sys.stdout
+    stream = getattr(sys.stdout, 'buffer', None)
+    if stream is None:
+        return sys.stdout
+    # anything printed before must come out first
+    sys.stdout.flush()
+    return stream
+
+class PackageKitLineOutput(object):
+    '''
+    Write every record to stdout and flush it straight away.
+
+    This is the historical behaviour of the python backends, every signal
+    costs one write and wakes up the daemon once.
+    '''
+
+    def write(self, record, flush=False):
+        '''
+        Send a record to the daemon
+        @param record: a complete, newline terminated record, or a frame
+        @param flush: the record must reach the daemon now
+        '''
+        stream = _stream(record)
+        stream.write(record)
+        stream.flush()
+
+    def flush(self):
+        '''
+        Push any pending record to the daemon
+        '''
+        sys.stdout.flush()
+
+class PackageKitBufferedOutput(PackageKitLineOutput):
+    '''
+    Collect records and write them to stdout in batches.
+
+    Pending records are written out once max_records or max_bytes is
+    reached, when the oldest one has waited max_delay seconds, or when a
+    record is sent with flush=True. A lone record written before a long
+    operation is sent by a background thread once max_delay is over.
+    Every batch is encoded once and written to the binary stream
+    underneath stdout.
+    '''
+
+    def __init__(self, max_records=512, max_bytes=65536, max_delay=0.1):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._records = []
+        self._size = 0
+        self._started = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._flusher = None
+
+    def write(self, record, flush=False):
+        with self._cond:
+            if not self._records:
+                self._started = time.time()
+                self._wake_flusher()
+            self._records.append(record)
+            self._size += len(record)
+            if flush or len(self._records) >= self.max_records or \
+               self._size >= self.max_bytes or \
+               time.time() - self._started >= self.max_delay:
+                self._flush()
+
+    def flush(self):
+        with self._cond:
+            self._flush()
+
+    def _flush(self):
+        if self._records:
+            data = self._records[0][:0].join(self._records)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8', 'replace')
+            stream = _stream(data)
+            stream.write(data)
+            stream.flush()
+            self._records = []
+            self._size = 0
+        sys.stdout.flush()
+
+    def _wake_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_late)
+            self._flusher.daemon = True
+            self._flusher.start()
+        else:
+            self._cond.notify()
+
+    def _flush_late(self):
+        with self._cond:
+            while True:
+                if not self._records:
+                    self._cond.wait()
+                    continue
+                delay = self._started + self.max_delay - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                self._flush()
+
+class PackageKitBlockOutput(PackageKitLineOutput):
+    '''
+    Keep all the records of one command in memory.
+
+    Used when commands run concurrently, the dispatcher writes each block
+    out in the order the commands were received so the output of every
+    command stays in one piece.
+    '''
+
+    def __init__(self):
+        self._records = []
+
+    def write(self, record, flush=False):
+        self._records.append(record)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        '''
+        Return all the records written so far
+        '''
+        if not self._records:
+            return ''
+        return self._records[0][:0].join(self._records)
+
+class PackageKitRecordingOutput(PackageKitLineOutput):
+    '''
+    Pass records on to another output and append them to a session log.
+
+    A session log has one entry per line, '>' and a tab followed by a
+    command read from stdin, or '<' and a tab followed by a record sent
+    to the daemon. packagekit.benchmark replays these logs. Frames are
+    logged as the line the record would have been sent as.
+    '''
+
+    def __init__(self, output, log, framed=False):
+        self.output = output
+        self.log = log
+        self.framed = framed
+
+    def command(self, args):
+        '''
+        Add a command to the log
+        @param args: the command and its arguments
+        '''
+        self.log.write('>\t%s\n' % '\t'.join(args))
+
+    def write(self, record, flush=False):
+        if self.framed:
+            for fields in framing.split_records(record):
+                self.log.write('<\t' + framing.format_record(fields))
+        else:
+            for line in record.splitlines(True):
+                self.log.write('<\t' + line)
+        if flush:
+            self.log.flush()
+        self.output.write(record, flush)
+
+    def flush(self):
+        self.output.flush()
+        self.log.flush()
@@ -17,10 +17,161 @@
 # Copyright (C) 2008
 #    Richard Hughes <richard@hughsie.com>
 
-from packagekit.backend import PackageKitEnum
+import os
+import re
+import time
+
+from packagekit.enums import PackageKitEnum
+
+_LICENSE_TOKENS = re.compile(r'\(|\)|[^\s()]+')
+
+class PackagekitLicenses(object):
+    '''
+    Decide if license expressions only use free licenses.
+
+    Usage:
+
+    licenses = PackagekitLicenses('/usr/share/PackageKit/helpers/yum/licenses.txt')
+    licenses.is_free('(GPLv2+ or Artistic) and MIT')
+
+    The free licenses are read once, one short name per line, and again
+    when the file's mtime changes. Expressions are compiled and their
+    results kept: there are a few hundred distinct license strings for
+    tens of thousands of packages.
+    '''
+
+    # seconds between two checks of the file's mtime
+    check_interval = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self.free = frozenset()
+        self._mtime = None
+        self._checked = 0
+        self._compiled = {}
+        self._results = {}
+
+    def _refresh(self):
+        now = time.time()
+        if self._mtime is not None and \
+           now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = -1
+        if mtime == self._mtime:
+            return
+        free = set()
+        if mtime != -1:
+            with open(self.path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        free.add(line)
+        self.free = frozenset(free)
+        self._results = {}
+        self._mtime = mtime
+
+    def compile(self, license_field):
+        '''
+        Return an expression as nested ('and', [...]) and ('or', [...])
+        tuples of license names, None for an empty one. " and " binds
+        looser than " or ", parenthesis group.
+        '''
+        try:
+            return self._compiled[license_field]
+        except KeyError:
+            pass
+        tokens = _LICENSE_TOKENS.findall(license_field)
+        terms = []
+        pos = 0
+        while pos < len(tokens):
+            if tokens[pos] == ')':
+                # unbalanced, ignore it
+                pos += 1
+                continue
+            node, pos = self._parse_and(tokens, pos)
+            terms.append(node)
+        if not terms:
+            expr = None
+        elif len(terms) == 1:
+            expr = terms[0]
+        else:
+            expr = ('and', terms)
+        self._compiled[license_field] = expr
+        return expr
+
+    def _parse_and(self, tokens, pos):
+        return self._parse_list(tokens, pos, 'and', self._parse_or)
+
+    def _parse_or(self, tokens, pos):
+        return self._parse_list(tokens, pos, 'or', self._parse_name)
+
+    def _parse_list(self, tokens, pos, op, parse):
+        node, pos = parse(tokens, pos)
+        nodes = [node]
+        while pos < len(tokens) and tokens[pos] == op:
+            node, pos = parse(tokens, pos + 1)
+            nodes.append(node)
+        if len(nodes) == 1:
+            return nodes[0], pos
+        return (op, nodes), pos
+
+    def _parse_name(self, tokens, pos):
+        if pos < len(tokens) and tokens[pos] == '(':
+            node, pos = self._parse_and(tokens, pos + 1)
+            if pos < len(tokens) and tokens[pos] == ')':
+                pos += 1
+            return node, pos
+        words = []
+        while pos < len(tokens) and \
+              tokens[pos] not in ('and', 'or', '(', ')'):
+            words.append(tokens[pos])
+            pos += 1
+        return (' '.join(words) or None), pos
+
+    def _evaluate(self, expr):
+        if expr is None:
+            return False
+        if not isinstance(expr, tuple):
+            return expr in self.free
+        op, nodes = expr
+        if op == 'and':
+            return all(self._evaluate(node) for node in nodes)
+        return any(self._evaluate(node) for node in nodes)
+
+    def is_free(self, license_field):
+        '''
+        Return if at least one license of every " and " group is free
+        '''
+        self._refresh()
+        try:
+            return self._results[license_field]
+        except KeyError:
+            pass
+        result = self._evaluate(self.compile(license_field))
+        self._results[license_field] = result
+        return result
+
+# one evaluator per license file, shared by all the packages
+_licenses = {}
+
+def get_licenses(path):
+    '''
+    Return the shared PackagekitLicenses of a license file
+    '''
+    try:
+        return _licenses[path]
+    except KeyError:
+        return _licenses.setdefault(path, PackagekitLicenses(path))
 
 class PackagekitPackage:
 
+    # free licenses used by check_license_field()
+    license_file = '/usr/share/PackageKit/helpers/yum/licenses.txt'
+
     def get_package_id(self, name, version, arch, data):
         return "%s;%s;%s;%s" % (name, version, arch, data)
 
@@ -52,38 +203,4 @@ class PackagekitPackage:
         is empty, the package is considered non-free.
         '''
 
-        groups = license_field.split(" and ")
-        f = open('/usr/share/PackageKit/helpers/yum/licenses.txt', 'r')
-        free_licenses = f.readlines()
-
-        if len(groups) == 0:
-            return False
-
-        one_free_group = False
-
-        for group in groups:
-            group = group.replace("(", "")
-            group = group.replace(")", "")
-            licenses = group.split(" or ")
-
-            group_is_free = False
-
-            for license in licenses:
-                license = license.strip()
-
-                if len(license) < 1:
-                    continue
-
-                if license in free_licenses:
-                    one_free_group = True
-                    group_is_free = True
-                    break
-
-            if group_is_free == False:
-                return False
-
-        if one_free_group == False:
-            return False
-
-        return True
-
+        return get_licenses(self.license_file).is_free(license_field)
@@ -17,6 +17,8 @@
 # Copyright (C) 2008
 #    Richard Hughes <richard@hughsie.com>
 
+import time
+
 try:
     from collections import Iterable
 except ImportError:
@@ -39,10 +41,17 @@ class PackagekitProgress(Iterable):
         # do the action is this step
         for i in range(100):
             # do some action
-            print "progress : %s " % milestone
+            progress.set_subpercent(i)
+            print "progress : %s, %s s left" % (progress.percent, progress.remaining)
+
+    The time of every step is recorded, elapsed, rate and remaining give
+    the time since the start, the smoothed number of steps per second and
+    the predicted number of seconds left. transferred() records the bytes
+    moved for bps.
     '''
 
-    #TODO: Add support for elapsed/remaining time
+    # weight of the latest step in the smoothed rates
+    smoothing = 0.3
 
     def __init__(self, steps=None):
         super(PackagekitProgress, self).__init__()
@@ -64,6 +73,19 @@ class PackagekitProgress(Iterable):
         self.percent = 0
         self.steps = []
         self.current_step = 0
+        self.started = time.time()
+        self.timestamps = [self.started]
+        self.rate = None
+        self.bps = None
+        self._percent_rate = None
+        self._stamp = (self.started, 0)
+        self._bytes_stamp = (self.started, 0)
+        self._bytes = 0
+
+    def _smooth(self, old, value):
+        if old is None:
+            return value
+        return self.smoothing * value + (1 - self.smoothing) * old
 
     def step(self):
         '''
@@ -71,19 +93,69 @@ class PackagekitProgress(Iterable):
         '''
         if self.current_step < len(self.steps)-1:
             self.current_step += 1
-            self.percent = self.steps[self.current_step]
+            self.percent = self.steps[self.current_step-1]
         else:
             self.current_step = len(self.steps)
             self.percent = 100
+        now = time.time()
+        elapsed = now - self.timestamps[-1]
+        self.timestamps.append(now)
+        if elapsed > 0:
+            self.rate = self._smooth(self.rate, 1.0 / elapsed)
+        self._update_rate(now)
+
+    def _update_rate(self, now):
+        stamp, percent = self._stamp
+        if now > stamp and self.percent > percent:
+            self._percent_rate = self._smooth(
+                self._percent_rate, (self.percent - percent) / (now - stamp))
+            self._stamp = (now, self.percent)
+
+    def transferred(self, size):
+        '''
+        Record bytes moved in the current step
+        @param size: number of bytes since the last call
+        '''
+        self._bytes += size
+        now = time.time()
+        stamp, total = self._bytes_stamp
+        if now > stamp:
+            self.bps = self._smooth(self.bps, (self._bytes - total) / (now - stamp))
+            self._bytes_stamp = (now, self._bytes)
+
+    @property
+    def elapsed(self):
+        '''
+        Seconds since the transaction started
+        '''
+        return time.time() - self.started
+
+    @property
+    def remaining(self):
+        '''
+        Predicted seconds until the end of the transaction, None until
+        there is a rate to predict it from
+        '''
+        if self.percent >= 100:
+            return 0
+        if not self._percent_rate:
+            return None
+        return (100 - self.percent) / self._percent_rate
 
     def __iter__(self):
         while self.current_step < len(self.steps):
             yield self.percent
             self.step()
 
-        raise StopIteration
+    def set_subpercent(self, subpercent):
+        '''
+        Set the progress inside the current step
+        @param subpercent: percentage of the current step done
+        '''
+        self._update_percent(subpercent)
+        self._update_rate(time.time())
 
-    def _update_percent(self):
+    def _update_percent(self, subpercent=100):
         '''
         Increment percentage based on current step
         '''
@@ -91,10 +163,9 @@ class PackagekitProgress(Iterable):
             startpct = 0
         else:
             startpct = self.steps[self.current_step-1]
-        if self.current_step < len(self.steps)-1:
-            endpct = self.steps[self.current_step+1]
+        if self.current_step < len(self.steps):
+            endpct = self.steps[self.current_step]
         else:
             endpct = 100
         incr = endpct -startpct
-        self.percent = startpct + incr
-
+        self.percent = startpct + incr * min(max(subpercent, 0), 100) / 100.0
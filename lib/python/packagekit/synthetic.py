@@ -0,0 +1,165 @@
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# This file contains a generator of fake package universes, the portage
+# and entropy backends serve them instead of the system package databases
+# when PK_BACKEND_SYNTHETIC is set to SIZE or SIZE:SEED
+#
+
+import os
+import random
+
+CATEGORIES = [
+    'app-accessibility', 'app-admin', 'app-arch', 'app-editors',
+    'app-office', 'dev-java', 'dev-lang', 'dev-libs', 'dev-python',
+    'dev-util', 'games-action', 'games-puzzle', 'gnome-base',
+    'gnome-extra', 'kde-apps', 'kde-frameworks', 'lxde-base',
+    'media-gfx', 'media-libs', 'media-sound', 'media-video', 'net-misc',
+    'net-p2p', 'sci-biology', 'sci-mathematics', 'sec-policy',
+    'sys-apps', 'sys-libs', 'x11-libs', 'x11-wm', 'xfce-base',
+]
+
+LICENSES = [
+    'GPL-2', 'GPL-2+', 'GPL-3', 'LGPL-2.1', 'MIT', 'BSD', 'Apache-2.0',
+    'MPL-2.0', 'freedist', 'all-rights-reserved', 'PUEL',
+    '|| ( GPL-2 MIT )', 'GPL-2 LGPL-2.1', 'ssl? ( openssl ) BSD',
+]
+
+# licenses of the list above approved by the FSF
+FREE_LICENSES = frozenset([
+    'GPL-2', 'GPL-2+', 'GPL-3', 'LGPL-2.1', 'MIT', 'BSD', 'Apache-2.0',
+    'MPL-2.0', 'openssl',
+])
+
+KEYWORDS = ['amd64', '~amd64', 'x86', '~x86', 'arm', '~arm64', 'ppc']
+
+WORDS = [
+    'audio', 'backup', 'browser', 'calendar', 'compiler', 'crypto',
+    'daemon', 'database', 'desktop', 'editor', 'font', 'game', 'graphics',
+    'image', 'kernel', 'library', 'mail', 'manager', 'media', 'monitor',
+    'network', 'parser', 'player', 'power', 'python', 'server', 'shell',
+    'sound', 'terminal', 'text', 'theme', 'toolkit', 'video', 'viewer',
+    'web', 'widget', 'xml',
+]
+
+class PackagekitSyntheticPackage(object):
+    '''
+    One version of a package in a synthetic universe
+    '''
+
+    __slots__ = ('index', 'category', 'name', 'version', 'revision', 'slot',
+                 'keywords', 'license', 'description', 'homepage', 'size',
+                 'depends', 'installed', 'repository')
+
+    @property
+    def cp(self):
+        return '%s/%s' % (self.category, self.name)
+
+    @property
+    def cpv(self):
+        if self.revision:
+            return '%s/%s-%s-r%d' % (self.category, self.name, self.version,
+                                     self.revision)
+        return '%s/%s-%s' % (self.category, self.name, self.version)
+
+class PackagekitSyntheticUniverse(object):
+    '''
+    A reproducible set of fake packages.
+
+    Usage:
+
+    universe = PackagekitSyntheticUniverse(20000, seed=1)
+    for pkg in universe.packages:
+        print(pkg.cpv, universe.contents(pkg))
+
+    Packages have one to four versions, a slot, keywords, a license
+    expression, a description made of common words and dependencies on
+    packages generated before them. File lists are built on demand.
+    '''
+
+    def __init__(self, size, seed=0, installed_ratio=0.1,
+                 repositories=('gentoo',)):
+        '''
+        @param size: number of package versions
+        @param seed: the same seed always gives the same universe
+        @param installed_ratio: share of the packages with one version installed
+        @param repositories: repositories the packages are spread across
+        '''
+        self.size = size
+        self.seed = seed
+        self.packages = []
+        rand = random.Random(seed)
+        cps = []
+
+        while len(self.packages) < size:
+            category = rand.choice(CATEGORIES)
+            name = '%s-%s%d' % (rand.choice(WORDS), rand.choice(WORDS),
+                                len(cps))
+            cp_depends = sorted(set(rand.sample(cps, min(len(cps),
+                                                         rand.randint(0, 5)))))
+            description = ' '.join(rand.sample(WORDS, 4)).capitalize()
+            repository = repositories[len(cps) % len(repositories)]
+            license_ = rand.choice(LICENSES)
+            cps.append('%s/%s' % (category, name))
+
+            nversions = min(rand.randint(1, 4), size - len(self.packages))
+            installed = rand.randrange(nversions) \
+                if rand.random() < installed_ratio else None
+            for i in range(nversions):
+                pkg = PackagekitSyntheticPackage()
+                pkg.index = len(self.packages)
+                pkg.category = category
+                pkg.name = name
+                pkg.version = '%d.%d.%d' % (i + 1, rand.randint(0, 20),
+                                            rand.randint(0, 9))
+                pkg.revision = rand.choice((0, 0, 0, 1, 2))
+                pkg.slot = str(i) if nversions > 2 else '0'
+                pkg.keywords = ' '.join(sorted(rand.sample(KEYWORDS, 3)))
+                pkg.license = license_
+                pkg.description = description
+                pkg.homepage = 'https://%s.example.org/' % name
+                pkg.size = rand.randint(1024, 64 * 1024 * 1024)
+                pkg.depends = cp_depends
+                pkg.installed = i == installed
+                pkg.repository = repository
+                self.packages.append(pkg)
+
+        self.categories = sorted(set(pkg.category for pkg in self.packages))
+
+    @classmethod
+    def from_environment(cls):
+        '''
+        Return the universe asked for with PK_BACKEND_SYNTHETIC, or None
+        '''
+        try:
+            value = os.environ['PK_BACKEND_SYNTHETIC']
+        except KeyError:
+            return None
+        size, sep, seed = value.partition(':')
+        return cls(int(size), int(seed or 0))
+
+    def contents(self, pkg):
+        '''
+        Return the files installed by a package
+        '''
+        rand = random.Random('%d:%d' % (self.seed, pkg.index))
+        files = ['/usr/share/doc/%s-%s/README' % (pkg.name, pkg.version)]
+        for i in range(rand.randint(1, 40)):
+            directory = rand.choice(('/usr/bin', '/usr/lib64',
+                                     '/usr/share/%s' % pkg.name,
+                                     '/usr/include/%s' % pkg.name))
+            files.append('%s/%s%d' % (directory, rand.choice(WORDS), i))
+        return files
@@ -0,0 +1,80 @@
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# This file contains the helpers used by the backends to find out if the
+# package databases or the configuration changed on disk
+#
+
+import os
+
+class PackagekitWatch(object):
+    '''
+    Remember the modification time of a set of files and directories.
+
+    Usage:
+
+    watch = PackagekitWatch(['/etc/make.conf'], ['/etc/portage'])
+    ...
+    if watch.changed():
+        reload_config()
+
+    The first call to changed() only records the current state.
+    '''
+
+    def __init__(self, paths=(), trees=()):
+        '''
+        @param paths: files or directories whose own mtime is checked
+        @param trees: directories checked recursively, for configuration
+        directories where editing a file does not touch the directory
+        '''
+        self.paths = list(paths)
+        self.trees = list(trees)
+        self._state = None
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _stat_tree(self, top):
+        state = []
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            for name in sorted(files) + dirs:
+                state.append((name, self._stat(os.path.join(root, name))))
+        return state
+
+    def snapshot(self):
+        '''
+        Return the current state of the watched paths
+        '''
+        return ([self._stat(path) for path in self.paths],
+                [self._stat_tree(top) for top in self.trees])
+
+    def changed(self):
+        '''
+        Return True if a watched path changed since the last call
+        '''
+        state = self.snapshot()
+        if self._state is None:
+            self._state = state
+            return False
+        if state == self._state:
+            return False
+        self._state = state
+        return True
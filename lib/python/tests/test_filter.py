@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Tests of packagekit.filter, run with the built packagekit package in
+# PYTHONPATH
+#
+
+import random
+import unittest
+
+from packagekit.enums import *
+from packagekit.filter import PackagekitFilter
+
+class _NameFilter(PackagekitFilter):
+    '''
+    Filter on (name, version, installed) tuples
+    '''
+
+    def _pkg_compare(self, pkg1, pkg2):
+        if pkg1[1] == pkg2[1]:
+            return 0
+        return 1 if pkg1[1] > pkg2[1] else -1
+
+    def _pkg_get_name(self, pkg):
+        return pkg[0]
+
+    def _pkg_is_installed(self, pkg):
+        return pkg[2]
+
+class _SlotFilter(_NameFilter):
+    '''
+    Filter on (name, (slot, version), installed) tuples, versions in
+    different slots can't be compared
+    '''
+
+    def _pkg_compare(self, pkg1, pkg2):
+        if pkg1[1][0] != pkg2[1][0]:
+            return -2
+        return _NameFilter._pkg_compare(self, (pkg1[0], pkg1[1][1]),
+                                        (pkg2[0], pkg2[1][1]))
+
+def _installed(name, version):
+    return (name, version, True)
+
+def _available(name, version):
+    return (name, version, False)
+
+class StreamingTest(unittest.TestCase):
+
+    def test_available_before_installed(self):
+        fltr = _NameFilter('none', stream=True)
+        self.assertTrue(fltr.streaming)
+        self.assertEqual(fltr.add_available([_available('a', 1)]), [])
+        self.assertEqual(fltr.add_installed([_installed('a', 2)]),
+                         [(_installed('a', 2), INFO_INSTALLED)])
+        # a-1 is older than the installed a-2
+        self.assertEqual(fltr.close('a'), [])
+        self.assertEqual(fltr.get_package_list(), [])
+
+    def test_installed_before_available(self):
+        fltr = _NameFilter('none', stream=True)
+        self.assertEqual(fltr.add_installed([_installed('a', 1)]),
+                         [(_installed('a', 1), INFO_INSTALLED)])
+        self.assertEqual(fltr.add_available([_available('a', 0),
+                                             _available('a', 2)]), [])
+        self.assertEqual(fltr.close('a'), [(_available('a', 2), INFO_AVAILABLE)])
+
+    def test_names_stream_as_they_are_closed(self):
+        fltr = _NameFilter('none', stream=True)
+        fltr.add_available([_available('a', 1)])
+        fltr.add_available([_available('b', 1)])
+        self.assertEqual(fltr.close('b'), [(_available('b', 1), INFO_AVAILABLE)])
+        self.assertEqual(fltr.close('b'), [])
+        # names never closed come out at the end
+        self.assertEqual(fltr.get_package_list(),
+                         [(_available('a', 1), INFO_AVAILABLE)])
+
+    def test_newest_streams(self):
+        fltr = _NameFilter('newest', stream=True)
+        self.assertTrue(fltr.streaming)
+        self.assertEqual(fltr.add_available([_available('a', 3),
+                                             _available('a', 2)]), [])
+        self.assertEqual(fltr.add_installed([_installed('a', 1)]), [])
+        self.assertEqual(sorted(fltr.close('a')),
+                         [(_installed('a', 1), INFO_INSTALLED),
+                          (_available('a', 3), INFO_AVAILABLE)])
+
+    def test_mixed_orders_match_buffered(self):
+        rand = random.Random(0)
+        packages = []
+        for name in 'abcdefgh':
+            versions = rand.sample(range(10), rand.randint(1, 5))
+            installed = rand.choice(versions + [None])
+            packages.extend(_installed(name, v) if v == installed
+                            else _available(name, v) for v in versions)
+        for filters in ('none', 'installed', '~installed', 'newest',
+                        '~newest', 'newest;~installed'):
+            buffered = _NameFilter(filters)
+            for pkg in packages:
+                buffered.add_custom(pkg, INFO_INSTALLED if pkg[2]
+                                    else INFO_AVAILABLE)
+            expected = sorted(buffered.get_package_list())
+            for i in range(20):
+                rand.shuffle(packages)
+                streamed = _NameFilter(filters, stream=True)
+                found = []
+                for pkg in packages:
+                    if pkg[2]:
+                        found.extend(streamed.add_installed([pkg]))
+                    else:
+                        found.extend(streamed.add_available([pkg]))
+                # close some of the names, leave the others to the end
+                for name in 'aceg':
+                    found.extend(streamed.close(name))
+                found.extend(streamed.get_package_list())
+                self.assertEqual(sorted(found), expected, filters)
+
+class SlotTest(unittest.TestCase):
+
+    def test_downgrade_compares_same_slot(self):
+        # a 2.x install doesn't hide the 1.x updates, whatever the order
+        for order in (0, 1):
+            fltr = _SlotFilter('none')
+            installed = [_installed('a', (1, 1)), _installed('a', (2, 5))]
+            if order:
+                installed.reverse()
+            for pkg in installed:
+                fltr.add_custom(pkg, INFO_INSTALLED)
+            for version in ((1, 0), (1, 1), (1, 2), (2, 4), (2, 6)):
+                fltr.add_custom(_available('a', version), INFO_AVAILABLE)
+            self.assertEqual(sorted(fltr.get_package_list()),
+                             sorted([(pkg, INFO_INSTALLED) for pkg in installed] +
+                                    [(_available('a', (1, 2)), INFO_AVAILABLE),
+                                     (_available('a', (2, 6)), INFO_AVAILABLE)]))
+
+    def test_newest_per_slot(self):
+        fltr = _SlotFilter('newest')
+        for version in ((2, 1), (1, 3), (2, 2), (1, 1)):
+            fltr.add_custom(_available('a', version), INFO_AVAILABLE)
+        self.assertEqual(sorted(fltr.get_package_list()),
+                         [(_available('a', (1, 3)), INFO_AVAILABLE),
+                          (_available('a', (2, 2)), INFO_AVAILABLE)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -719,6 +719,37 @@ pk_test_spawn_func (void)
 	/* ask dispatcher to close (again) */
 	ret = pk_spawn_exit (spawn);
 	g_assert (!ret);
+
+	/* get new object */
+	new_spawn_object (&spawn);
+
+	/* run the dispatcher with a slow command */
+	mexit = PK_SPAWN_EXIT_TYPE_UNKNOWN;
+	g_strfreev (argv);
+	argv = g_strsplit (TESTDATADIR "/pk-spawn-dispatcher.py\tsearch-details\tnone\tpower", "\t", 0);
+	ret = pk_spawn_argv (spawn, argv, envp, PK_SPAWN_ARGV_FLAGS_NONE, &error);
+	g_assert_no_error (error);
+	g_assert (ret);
+
+	/* wait for the dispatcher to start the command */
+	_g_test_loop_wait (2500);
+
+	/* queue more slow commands behind it */
+	for (guint i = 0; i < 4; i++) {
+		ret = pk_spawn_argv (spawn, argv, envp, PK_SPAWN_ARGV_FLAGS_NONE, &error);
+		g_assert_no_error (error);
+		g_assert (ret);
+	}
+
+	/* exit drops the queued commands, only the running one finishes */
+	g_test_timer_start ();
+	ret = pk_spawn_exit (spawn);
+	g_assert (ret);
+	g_assert_cmpfloat (g_test_timer_elapsed (), <, 2.5);
+
+	/* did dispatcher close? */
+	g_assert (!pk_spawn_is_running (spawn));
+	g_assert_cmpint (mexit, ==, PK_SPAWN_EXIT_TYPE_DISPATCHER_EXIT);
 }
 
 static void